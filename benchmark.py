@@ -0,0 +1,156 @@
+import os
+import platform
+import tempfile
+import time
+import numpy as np
+import scipy.signal
+import soundfile
+import functions as fu
+import hashindex
+import identify
+import profiling
+
+# Synthetic tracks are note sequences: a few sustained partials per note, sliding chirps and a noise floor
+NOTE_SECONDS = (0.1, 0.6)
+PARTIALS = (1, 4)
+CHIRPS_PER_SECOND = 0.5
+NOISE_LEVEL = 0.01
+# Query distortions: gain in dB, signal to noise ratio in dB and the rates clips are resampled to
+GAIN_DB = (-12, 6)
+SNR_DB = 10
+QUERY_RATES = (8000, 11025, 16000, 22050, 44100)
+TOP = (1, 5)
+
+
+def synth_track(rng, seconds, sample_rate=fu.SAMPLE_RATE):
+    '''Returns seconds of a random mixture of tones, chirps and noise'''
+    n = int(seconds * sample_rate)
+    track = np.zeros(n)
+    start = 0
+    while start < n:
+        length = int(rng.uniform(*NOTE_SECONDS) * sample_rate)
+        t = np.arange(min(length, n - start)) / sample_rate
+        envelope = np.exp(-t * rng.uniform(1, 8))
+        for _ in range(rng.integers(*PARTIALS, endpoint=True)):
+            frequency = rng.uniform(100, fu.FMAX)
+            track[start:start + len(t)] += rng.uniform(0.1, 1) * envelope * np.sin(2 * np.pi * frequency * t)
+        start += length
+    for _ in range(rng.poisson(CHIRPS_PER_SECOND * seconds)):
+        length = int(rng.uniform(0.2, 1.5) * sample_rate)
+        begin = rng.integers(0, max(n - length, 1))
+        t = np.arange(min(length, n - begin)) / sample_rate
+        chirp = scipy.signal.chirp(t, rng.uniform(100, fu.FMAX), t[-1], rng.uniform(100, fu.FMAX))
+        track[begin:begin + len(t)] += rng.uniform(0.1, 0.5) * chirp * np.hanning(len(t))
+    track += rng.normal(0, NOISE_LEVEL, n)
+    return (track / np.abs(track).max() * 0.9).astype(np.float32)
+
+
+def generate_corpus(directory, tracks, seconds, seed=0):
+    '''Writes `tracks` synthetic wav files to directory, skipping the ones already there.
+    The same seed always gives the same corpus. Returns their paths'''
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(tracks):
+        path = os.path.join(directory, f'track{i:05d}.wav')
+        if not os.path.exists(path):
+            rng = np.random.default_rng([seed, i])
+            soundfile.write(path, synth_track(rng, seconds), fu.SAMPLE_RATE)
+        paths.append(path)
+    return paths
+
+
+def distort(clip, rng, snr_db=SNR_DB):
+    '''Changes the gain of clip, adds white noise at snr_db and resamples it to a random rate.
+    Returns (clip, sample_rate)'''
+    clip = clip * 10 ** (rng.uniform(*GAIN_DB) / 20)
+    noise = rng.normal(0, 1, len(clip))
+    clip = clip + noise * np.sqrt(np.mean(clip ** 2) / 10 ** (snr_db / 10))
+    rate = int(rng.choice(QUERY_RATES))
+    if rate != fu.SAMPLE_RATE:
+        divisor = np.gcd(rate, fu.SAMPLE_RATE)
+        clip = scipy.signal.resample_poly(clip, rate // divisor, fu.SAMPLE_RATE // divisor)
+    return np.clip(clip, -1, 1).astype(np.float32), rate
+
+
+def make_queries(paths, directory, queries, clip_seconds, snr_db=SNR_DB, seed=0):
+    '''Cuts `queries` distorted clips at random offsets of random tracks into directory.
+    Returns a list of (clip path, track path, offset in seconds)'''
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng([seed, len(paths), queries])
+    truth = []
+    for i in range(queries):
+        path = paths[rng.integers(len(paths))]
+        track, _ = soundfile.read(path, dtype='float32')
+        length = min(int(clip_seconds * fu.SAMPLE_RATE), len(track))
+        offset = rng.integers(0, len(track) - length + 1)
+        clip, rate = distort(track[offset:offset + length], rng, snr_db)
+        clip_path = os.path.join(directory, f'query{i:05d}.wav')
+        soundfile.write(clip_path, clip, rate)
+        truth.append((clip_path, path, offset / fu.SAMPLE_RATE))
+    return truth
+
+
+def percentiles(values):
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return {}
+    return {f'p{q}': float(np.percentile(values, q)) for q in (50, 95, 99)}
+
+
+def run(corpus_dir=None, tracks=50, seconds=30, queries=100, clip_seconds=5, snr_db=SNR_DB, seed=0,
+        workers=fu.WORKERS, binwidth=fu.BINWIDTH):
+    '''Generates (or reuses) a corpus, indexes it, identifies distorted clips of it.
+    Returns a JSON-serializable dict of settings and results'''
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus_dir = corpus_dir or os.path.join(tmp, 'corpus')
+        paths = generate_corpus(os.path.join(corpus_dir, f'tracks-{seed}'), tracks, seconds, seed)
+        truth = make_queries(paths, os.path.join(tmp, 'queries'), queries, clip_seconds, snr_db, seed)
+
+        start = time.perf_counter()
+        index = fu.create_index(tuple(paths), multiprocess=workers != 0, workers=workers)
+        ingest_seconds = time.perf_counter() - start
+        index_path = os.path.join(tmp, 'index.rzi')
+        hashindex.save_index(index, index_path)
+        index_bytes = os.path.getsize(index_path)
+        posting_lengths = fu.posting_stats(index, top=0).get('lengths')
+
+        k = max(max(TOP), fu.TOP_K)
+        # the first query pays for lazy imports and filter bank setup, it isn't timed
+        if truth:
+            identify.identify_sample(truth[0][0], index, binwidth, k)
+        latencies, score_latencies, hits, offset_errors, errors = [], [], {top: 0 for top in TOP}, [], 0
+        summary = profiling.Summary()
+        profiling.add_callback(summary)
+        for clip_path, track_path, offset in truth:
+            result = identify.identify_sample(clip_path, index, binwidth, k)
+            latencies.append(result['timings']['total'])
+            score_latencies.append(result['timings']['score'])
+            errors += 'error' in result
+            found = [match['path'] for match in result['matches']]
+            for top in TOP:
+                hits[top] += track_path in found[:top]
+            if found and found[0] == track_path:
+                offset_errors.append(abs(result['matches'][0]['offset'] - offset))
+        profiling.remove_callback(summary)
+    rss, children_rss = profiling.peak_rss()
+
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'settings': {
+            'tracks': tracks, 'seconds': seconds, 'queries': queries, 'clip_seconds': clip_seconds,
+            'snr_db': snr_db, 'seed': seed, 'workers': workers, 'binwidth': binwidth,
+            'neighborhood_size': fu.NEIGHBORHOOD_SIZE, 'n_mels': fu.N_MELS, 'min_peak_db': fu.MIN_PEAK_DB,
+            'max_peaks_per_cell': fu.MAX_PEAKS_PER_CELL, 'target_dt_max': fu.TARGET_DT_MAX,
+            'target_df_max': fu.TARGET_DF_MAX, 'fan_out': fu.FAN_OUT,
+        },
+        'ingest': {'seconds': ingest_seconds, 'tracks_per_second': len(index) / ingest_seconds},
+        'index': {'tracks': len(index), 'postings': len(index.track_ids), 'bytes': index_bytes,
+                  'bytes_per_track': index_bytes / max(len(index), 1), 'posting_lengths': posting_lengths},
+        'latency': {'total': percentiles(latencies), 'score': percentiles(score_latencies)},
+        'accuracy': {**{f'top{top}': hits[top] / max(queries, 1) for top in TOP},
+                     'median_offset_error': float(np.median(offset_errors)) if offset_errors else None,
+                     'errors': errors},
+        'memory': {'peak_rss': rss, 'peak_rss_children': children_rss},
+        'query_stages': summary.as_dict().get('query'),
+    }
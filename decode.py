@@ -0,0 +1,179 @@
+import os
+from math import gcd
+import numpy as np
+import scipy.signal
+import soundfile
+import profiling
+
+AUDIO_EXTENSIONS = {'.wav', '.wave', '.flac', '.ogg', '.oga', '.opus', '.mp3', '.m4a', '.mp4', '.aac',
+                    '.aif', '.aiff', '.aifc', '.au', '.snd', '.wma', '.caf', '.w64'}
+# Seconds of audio decoded at once
+BLOCK_SECONDS = 10
+
+
+def sniff(path):
+    '''Returns the container format guessed from the first bytes of a file, or None'''
+    try:
+        with open(path, 'rb') as file:
+            head = file.read(12)
+    except OSError:
+        return None
+    if head[:4] in (b'RIFF', b'RF64') and head[8:12] == b'WAVE' or head[:4] == b'riff':
+        return 'wav'
+    if head[:4] == b'fLaC':
+        return 'flac'
+    if head[:4] == b'OggS':
+        return 'ogg'
+    if head[:3] == b'ID3' or (len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0):
+        # mp3 frames and ADTS aac share the frame sync
+        return 'mpeg'
+    if head[:4] == b'FORM' and head[8:12] in (b'AIFF', b'AIFC'):
+        return 'aiff'
+    if head[:4] == b'.snd':
+        return 'au'
+    if head[4:8] == b'ftyp':
+        return 'mp4'
+    if head[:4] == b'\x30\x26\xb2\x75':
+        return 'asf'
+    if head[:4] == b'caff':
+        return 'caf'
+    return None
+
+
+def is_audio_file(path):
+    '''Cheap check before decoding: a known audio extension and matching magic bytes'''
+    return os.path.splitext(path)[1].lower() in AUDIO_EXTENSIONS and sniff(path) is not None
+
+
+def iter_files(dir_path, recursive=False, audio_only=True):
+    '''Lazily yields paths of files in dir_path, by default only the ones is_audio_file accepts'''
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if recursive and entry.is_dir():
+                yield from iter_files(entry, recursive=True, audio_only=audio_only)
+            elif entry.is_file() and (not audio_only or is_audio_file(entry.path)):
+                yield entry.path
+
+
+def iter_samples(paths, recursive=False):
+    '''Yields the audio files of directories among paths and the other paths as they are'''
+    for path in paths:
+        if os.path.isdir(path):
+            yield from iter_files(path, recursive)
+        else:
+            yield path
+
+
+class BlockResampler:
+    '''Polyphase resampling of audio that arrives in blocks. Gives the samples
+    scipy.signal.resample_poly gives for the whole signal, holding back only
+    the few input samples the filter needs past the end of the last block'''
+
+    def __init__(self, orig_rate, target_rate):
+        divisor = gcd(int(orig_rate), int(target_rate))
+        self.up = int(target_rate) // divisor
+        self.down = int(orig_rate) // divisor
+        # input samples the filter of resample_poly reaches on either side, rounded up to a multiple
+        # of down so the buffer always starts on an input sample that maps onto an output sample
+        reach = 10 * max(self.up, self.down) // self.up + 1
+        self.context = -(-reach // self.down) * self.down
+        self.buffer = np.empty(0, dtype=np.float32)
+        self.buffer_start = 0
+        self.received = 0
+        self.done = 0
+
+    def feed(self, block):
+        '''Returns the output samples completed by block'''
+        if self.up == self.down:
+            return np.asarray(block, dtype=np.float32)
+        self.buffer = np.concatenate((self.buffer, np.asarray(block, dtype=np.float32)))
+        self.received += len(block)
+        return self.resample(self.received - self.context)
+
+    def flush(self):
+        '''Returns the remaining output samples'''
+        if self.up == self.down:
+            return np.empty(0, dtype=np.float32)
+        return self.resample(self.received)
+
+    def resample(self, inputs_done):
+        '''Resamples the buffer and returns the outputs that fall before input sample inputs_done'''
+        stop = -(-max(inputs_done, 0) * self.up // self.down)
+        if stop <= self.done:
+            return np.empty(0, dtype=np.float32)
+        first = self.buffer_start * self.up // self.down
+        resampled = scipy.signal.resample_poly(self.buffer, self.up, self.down)
+        output = resampled[self.done - first:stop - first].astype(np.float32)
+        self.done = stop
+
+        start = max(self.done * self.down // self.up - self.context, 0) // self.down * self.down
+        self.buffer = self.buffer[start - self.buffer_start:]
+        self.buffer_start = start
+        return output
+
+
+def read_blocks_soundfile(path, block_seconds):
+    '''Yields (mono block, sample rate), raises RuntimeError if libsndfile can't read path'''
+    with soundfile.SoundFile(path) as file:
+        while True:
+            with profiling.stage('load'):
+                block = file.read(int(block_seconds * file.samplerate), dtype='float32', always_2d=True)
+            if len(block) == 0:
+                return
+            yield block.mean(axis=1) if block.shape[1] > 1 else block[:, 0], file.samplerate
+
+
+def read_blocks_audioread(path, block_seconds):
+    '''Yields (mono block, sample rate) decoded by audioread's backends (e.g. ffmpeg)'''
+    import audioread
+    with audioread.audio_open(path) as file:
+        block_size = int(block_seconds * file.samplerate) * file.channels
+        pending, pending_size = [], 0
+        buffers = iter(file)
+        while True:
+            with profiling.stage('load'):
+                buffer = next(buffers, None)
+                if buffer is not None:
+                    pending.append(np.frombuffer(buffer, dtype='<i2'))
+                    pending_size += len(pending[-1])
+            if buffer is None or pending_size >= block_size:
+                samples = np.concatenate(pending) if pending else np.empty(0, dtype='<i2')
+                pending, pending_size = [], 0
+                if len(samples):
+                    samples = samples.reshape(-1, file.channels) / np.float32(32768)
+                    yield samples.mean(axis=1, dtype=np.float32), file.samplerate
+            if buffer is None:
+                return
+
+
+def iter_blocks(path, sample_rate, block_seconds=BLOCK_SECONDS):
+    '''Decodes path block by block with soundfile, or audioread for formats libsndfile can't read.
+    Lazily yields mono float32 blocks resampled to sample_rate.
+    Raises ValueError if neither can decode path'''
+    import audioread
+    readers = (read_blocks_soundfile, read_blocks_audioread)
+    for reader in readers:
+        resampler = None
+        try:
+            for block, native_rate in reader(path, block_seconds):
+                if resampler is None:
+                    resampler = BlockResampler(native_rate, sample_rate)
+                with profiling.stage('resample'):
+                    block = resampler.feed(block)
+                yield block
+            if resampler is not None:
+                with profiling.stage('resample'):
+                    block = resampler.flush()
+                yield block
+            return
+        except (RuntimeError, audioread.DecodeError, EOFError) as e:
+            if resampler is not None:
+                # part of the audio was yielded already, another decoder can't take over
+                raise ValueError(f'Could not decode {path}: {e}') from e
+    raise ValueError(f'Could not decode {path}')
+
+
+def load(path, sample_rate):
+    '''Returns the whole mono time series of path at sample_rate'''
+    blocks = list(iter_blocks(path, sample_rate))
+    return np.concatenate(blocks) if blocks else np.empty(0, dtype=np.float32)
@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+# Default size limit of a cache directory
+MAX_BYTES = 2 << 30
+# The size limit is checked after this many writes by one instance,
+# and by fingerprint_files after this many files fingerprinted by a worker pool
+EVICT_EVERY = 64
+
+
+class FeatureCache:
+    '''On-disk cache of per-file features (constellations, optionally mel spectrograms).
+    Entries are .npy files keyed by the audio content hash plus the parameters the feature
+    was computed with. Reads refresh the file mtime, and the least recently used entries
+    are deleted once the directory grows over max_bytes.
+    Instances are picklable, so worker processes can share one cache directory'''
+
+    def __init__(self, directory, max_bytes=MAX_BYTES, spectrograms=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.spectrograms = spectrograms
+        self.writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, content_hash, kind, params):
+        params = json.dumps(params, sort_keys=True)
+        return hashlib.sha1(f'{content_hash}:{kind}:{params}'.encode('utf-8')).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.npy')
+
+    def get(self, key):
+        path = self.entry_path(key)
+        try:
+            array = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return array
+
+    def put(self, key, array):
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as file:
+            np.save(file, array)
+        os.replace(tmp_path, path)
+        self.writes += 1
+        if self.writes % EVICT_EVERY == 0:
+            self.evict()
+
+    def entries(self):
+        for subdir in os.scandir(self.directory):
+            if subdir.is_dir():
+                yield from (entry for entry in os.scandir(subdir.path) if entry.name.endswith('.npy'))
+
+    def evict(self):
+        '''Deletes least recently used entries until the cache fits in max_bytes'''
+        entries = []
+        for entry in self.entries():
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
@@ -1,153 +1,541 @@
 import librosa
 import os
-import pickle
+import sys
 import numpy as np
 import multiprocessing as mp
-import scipy.ndimage as ndimage
+from collections import namedtuple
+from contextlib import nullcontext
+from functools import partial
+import scipy.fft
+import scipy.signal
 from scipy.ndimage.filters import maximum_filter
-from audioread import NoBackendError
+import decode
+import hashindex
+import profiling
+import segments
+from hashindex import Index, pack_hashes
+from segments import SegmentedIndex, content_hash
+from featurecache import FeatureCache, EVICT_EVERY
+from decode import iter_files
 
 NEIGHBORHOOD_SIZE = 20
+N_MELS = 256
+FMAX = 4000
+# Peaks quieter than this (dB below the loudest point of the track) are ignored
+MIN_PEAK_DB = -60
+# Optional cap of peaks kept in every PEAK_WINDOW frames x PEAK_BAND mel bins cell, None disables it
+MAX_PEAKS_PER_CELL = None
+PEAK_WINDOW = 43
+PEAK_BAND = 32
+# Target zone of an anchor peak: later peaks at most TARGET_DT_MAX frames ahead and
+# TARGET_DF_MAX mel bins away, of which the first FAN_OUT are paired with the anchor
+TARGET_DT_MAX = 128
+TARGET_DF_MAX = N_MELS
+FAN_OUT = 20
 SAMPLE_RATE = 22050
-CPUs = 4
+N_FFT = 2048
+HOP_LENGTH = 512
+# Number of ingestion worker processes, None means os.cpu_count()
+WORKERS = None
+# Files handed to a worker at once
+CHUNKSIZE = 4
+# A sync writes a segment every SEGMENT_FILES fingerprinted files, so ingestion memory doesn't grow with the library
+SEGMENT_FILES = 200
+# Width of an offset difference bin in spectrogram frames
+BINWIDTH = 150
+TOP_K = 6
+# Tracks with the most (weighted) hash hits that get offset alignment scoring
+CANDIDATES = 50
+# Stop-list: hashes with more postings than this are skipped at query time, None keeps them all
+MAX_POSTINGS = 10000
+# Weight every matched hash by log(1 + tracks / postings of the hash) instead of counting it once
+WEIGHT_BY_RARITY = True
+# Keeps negative offset difference bins positive in histogram keys
+BIN_BIAS = 1 << 31
 
-def get_list_of_files(dir_path, recursive=False):
-    files = []
-    with os.scandir(dir_path) as entries:
-        for entry in entries:
-            if recursive and entry.is_dir():
-                files.extend(get_list_of_files(entry, recursive=True))
-            elif entry.is_file():
-                files.append(entry.path)
-    return files
+# offset is the position of the sample in the matched track, in seconds
+# count -- hashes aligned in the best offset bin, score -- the same hashes weighted by rarity
+Match = namedtuple('Match', ['path', 'count', 'offset', 'score'], defaults=(None,))
+
+def get_list_of_files(dir_path, recursive=False, audio_only=True):
+    return list(iter_files(dir_path, recursive, audio_only))
 
 
 def load_and_resample(audiofile_path, sample_rate=SAMPLE_RATE):
-    import audioread
     '''Loads and resamples audio file
     Returns a (audiofile_path, time_series) tuple'''
     try:
-        ts, _ = librosa.load(audiofile_path, sr=sample_rate, res_type='kaiser_fast')
-    except NoBackendError:
-        print(f'Could not load {audiofile_path} as audio')
+        ts = decode.load(audiofile_path, sample_rate) if decode.sniff(audiofile_path) else None
+    except ValueError:
+        ts = None
+    if ts is None:
+        print(f'Could not load {audiofile_path} as audio', file=sys.stderr)
         return None
+    profiling.count('audio_samples', len(ts))
     return (audiofile_path, ts)
 
 
-def load_and_resample_dir(dir_path, recursive=False):
-    '''Loads and resamples audio files given in dir_path
-    Returns a list of (audio_path, time_series) tuples'''
-    files = get_list_of_files(dir_path, recursive)
-    ts_collection = [tup for file in files if (tup := load_and_resample(file)) is not None]
-    return ts_collection
+def pair_peaks(constellation, max_dt=TARGET_DT_MAX, max_df=TARGET_DF_MAX, fan_out=FAN_OUT):
+    '''Pairs every anchor peak with at most fan_out later peaks of its target zone:
+    1 <= dt <= max_dt frames ahead and |df| <= max_df mel bins away.
+    constellation -- an (n, 2) array of (t, f) peaks sorted by time
+    Returns (anchors, targets) arrays of positions in constellation'''
+    t, f = constellation[:, 0], constellation[:, 1]
+    anchors = np.arange(len(t))
+    stops = np.searchsorted(t, t + max_dt, side='right')
+    width = int((stops - anchors).max(initial=1)) - 1
+    if width <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
 
+    # candidate targets are the next `width` peaks of every anchor
+    targets = anchors[:, None] + np.arange(1, width + 1)
+    in_zone = targets < stops[:, None]
+    targets = np.minimum(targets, len(t) - 1)
+    in_zone &= (t[targets] > t[:, None]) & (np.abs(f[targets] - f[:, None]) <= max_df)
+    in_zone &= np.cumsum(in_zone, axis=1) <= fan_out
+
+    rows, cols = np.nonzero(in_zone)
+    return rows, targets[rows, cols]
+
+
+def hash_pairs(constellation, anchors, targets):
+    '''Returns (hashes, offsets) arrays of packed (f1, f2, dt) keys and anchor times'''
+    t, f = constellation[:, 0], constellation[:, 1]
+    return pack_hashes(f[anchors], f[targets], t[targets] - t[anchors]), t[anchors].astype(np.uint32)
+
+
+def get_hashes(constellation, max_dt=TARGET_DT_MAX, max_df=TARGET_DF_MAX, fan_out=FAN_OUT):
+    '''Returns (hashes, offsets) arrays of packed (f1, f2, dt) keys and anchor times
+    for the pairs made by pair_peaks'''
+    with profiling.stage('hashing'):
+        constellation = np.asarray(constellation, dtype=np.int64).reshape(-1, 2)
+        hashes, offsets = hash_pairs(constellation, *pair_peaks(constellation, max_dt, max_df, fan_out))
+    profiling.count('hashes', len(hashes))
+    return hashes, offsets
+
+
+class MelFramer:
+    '''Turns audio fed in blocks into mel power frames, the frames of librosa's centered
+    melspectrogram of the whole audio, keeping only the samples of the next incomplete frame'''
+
+    def __init__(self, sample_rate=SAMPLE_RATE):
+        self.mel_basis = librosa.filters.mel(sr=sample_rate, n_fft=N_FFT, n_mels=N_MELS, fmax=FMAX)
+        self.window = scipy.signal.get_window('hann', N_FFT, fftbins=True).astype(np.float32)
+        # frames are centered, so the audio starts with half a window of padding
+        self.audio = np.zeros(N_FFT // 2, dtype=np.float32)
+        self.samples = 0
+
+    def feed(self, samples):
+        '''Returns a (mel, time) float32 array of the frames completed by samples'''
+        audio = np.concatenate((self.audio, np.asarray(samples, dtype=np.float32)))
+        self.samples += len(samples)
+        n = 1 + (len(audio) - N_FFT) // HOP_LENGTH if len(audio) >= N_FFT else 0
+        if n == 0:
+            self.audio = audio
+            return np.empty((N_MELS, 0), dtype=np.float32)
+        positions = np.arange(N_FFT) + HOP_LENGTH * np.arange(n)[:, None]
+        # single precision like librosa's stft, and about twice as fast as numpy's double precision fft
+        spectra = np.abs(scipy.fft.rfft(audio[positions] * self.window, axis=1)) ** 2
+        self.audio = audio[n * HOP_LENGTH:]
+        return self.mel_basis @ spectra.T
+
+    def flush(self):
+        '''Pads the end like the start and returns the last frames'''
+        return self.feed(np.zeros(N_FFT // 2, dtype=np.float32))
+
+
+def power_to_db(frames):
+    '''Returns a (mel, time) spectrogram in dB relative to its maximum'''
+    S = librosa.power_to_db(frames, ref=np.max)
+    profiling.gauge('spectrogram_bytes', S.nbytes)
+    return S
+
+
+def mel_spectrogram(ts, sample_rate=SAMPLE_RATE):
+    '''Returns a (mel, time) spectrogram in dB relative to its maximum'''
+    framer = MelFramer(sample_rate)
+    with profiling.stage('melspectrogram'):
+        return power_to_db(np.hstack((framer.feed(ts), framer.flush())))
+
+
+def load_spectrogram(path, sample_rate=SAMPLE_RATE):
+    '''Decodes an audio file block by block straight into mel frames, so its whole audio
+    is never in memory. Returns the (mel, time) dB spectrogram, or None if path is not audio'''
+    framer = MelFramer(sample_rate)
+    frames = []
+    try:
+        if decode.sniff(path) is None:
+            raise ValueError(f'{path} is not audio')
+        for block in decode.iter_blocks(path, sample_rate):
+            with profiling.stage('melspectrogram'):
+                frames.append(framer.feed(block))
+    except ValueError:
+        print(f'Could not load {path} as audio', file=sys.stderr)
+        return None
+    profiling.count('audio_samples', framer.samples)
+    with profiling.stage('melspectrogram'):
+        frames.append(framer.flush())
+        return power_to_db(np.hstack(frames))
 
-def build_constellation_index(constellation_collection, multiprocess=False, pool=None):
-    '''If multiprocess == True, multiprocessing.Pool must be provided'''
-    result_index = {}
-    if multiprocess:
-        hashes_collection = [pool.apply(get_hashes, args=(name, con)) for (name, con) in constellation_collection]
-        result_index = {k:v for element in hashes_collection for k,v in element.items()}
-    else:
-        for name, con in constellation_collection:
-            hashes = get_hashes(name, con)
-            result_index.update(hashes)
-    return result_index
 
+def find_peaks(S, min_db=MIN_PEAK_DB, max_peaks=MAX_PEAKS_PER_CELL):
+    '''S -- a (mel, time) dB spectrogram
+    Returns an (n, 2) array of (t, f) peaks sorted by time'''
+    with profiling.stage('peaks'):
+        is_max = maximum_filter(S, NEIGHBORHOOD_SIZE) == S
+        # maxima on flat regions (e.g. silence at the dB floor) touch another maximum, drop them
+        plateau = np.zeros_like(is_max)
+        plateau[1:, :] |= is_max[:-1, :]
+        plateau[:-1, :] |= is_max[1:, :]
+        plateau[:, 1:] |= is_max[:, :-1]
+        plateau[:, :-1] |= is_max[:, 1:]
+        f, t = np.nonzero(is_max & ~plateau & (S >= min_db))
+        if max_peaks is not None:
+            keep = limit_peak_density(t, f, S[f, t], max_peaks)
+            t, f = t[keep], f[keep]
+        order = np.lexsort((f, t))
+    profiling.count('peaks', len(t))
+    return np.stack((t[order], f[order]), axis=1)
 
-def get_hashes(name, constellation):
-    hashes = {}
-    for i, (t1, f1) in enumerate(constellation):
-        # My target zone is considered to be 40 points around the anchor point
-        target_points = constellation[i-20 : i+20]
-        for t2, f2 in target_points:
-            dt = t2 - t1
-            hashes.setdefault((f1, f2, dt), []).append((t1, name))
-    return hashes
 
+def limit_peak_density(t, f, amplitudes, max_peaks, window=PEAK_WINDOW, band=PEAK_BAND):
+    '''Returns positions of the max_peaks loudest peaks of every (time window, frequency band) cell'''
+    cells = (t // window) * (N_MELS // band + 1) + f // band
+    order = np.lexsort((-amplitudes, cells))
+    sorted_cells = cells[order]
+    rank = np.arange(len(order)) - np.searchsorted(sorted_cells, sorted_cells)
+    return order[rank < max_peaks]
 
-def form_constellation(ts, sample_rate=SAMPLE_RATE):
+
+def form_constellation(ts, sample_rate=SAMPLE_RATE, min_db=MIN_PEAK_DB, max_peaks=MAX_PEAKS_PER_CELL):
     '''ts -- a single time series'''
-    S = librosa.feature.melspectrogram(ts, sr=sample_rate, n_mels=256, fmax=4000)
-    S = librosa.power_to_db(S, ref=np.max)
-    # get local maxima
-    Sb = maximum_filter(S, NEIGHBORHOOD_SIZE) == S
-    
-    Sbd, num_objects = ndimage.label(Sb)
-    objs = ndimage.find_objects(Sbd)
-    points = []
-    for dy, dx in objs:
-        x_center = (dx.start + dx.stop - 1) // 2
-        y_center = (dy.start + dy.stop - 1) // 2    
-        if (dx.stop - dx.start) * (dy.stop - dy.start) == 1:
-            points.append((x_center, y_center))
-    return sorted(points)
-
-
-def get_offset_diffs(sample, index):
-    offset_diffs = {}
-
-    for key, value in sample.items():
-        if key in index:
-            for sample_offset, _ in value:
-                for db_offset, name in index[key]:
-                    offset_diffs.setdefault(name, []).append(db_offset - sample_offset)
-    return offset_diffs
-
-
-def get_best_matches(offset_diffs):
-    binwidth = 150
-    max_matches = []
-
-    for name, diffs in offset_diffs.items():
-        hist, _ = np.histogram(diffs, bins=range(min(diffs), max(diffs) + binwidth, binwidth))
-        m = np.max(hist)
-        max_matches.append((name, m))
-    best_matches = sorted(max_matches, key=lambda x: x[1], reverse=True)
-
-    return [path for path, _ in best_matches]
-
-
-def path_and_constellation(path_ts):
-    path, ts = path_ts
-    return (path, form_constellation(ts))
-
-
-def create_index(path, recursive=False, multiprocess=False):
-    if os.path.isfile(path):
-        ts_coll = [load_and_resample(path)]
+    return find_peaks(mel_spectrogram(ts, sample_rate), min_db, max_peaks)
+
+
+def peaks_per_second(constellation, num_samples, sample_rate=SAMPLE_RATE):
+    return len(constellation) * sample_rate / max(num_samples, 1)
+
+
+def lookup_postings(hashes, offsets, index, max_postings=MAX_POSTINGS, weighted=WEIGHT_BY_RARITY):
+    '''Looks up a sample's hashes and their offsets, skipping hashes with more than max_postings postings.
+    Returns (positions, track_ids, diffs, weights) arrays, one entry per posting shared by sample and index,
+    where positions index into hashes'''
+    with profiling.stage('offset_diffs'):
+        hashes = np.asarray(hashes, dtype=hashindex.HASH_DTYPE)
+        lengths = index.posting_lengths(hashes) if max_postings is not None or weighted else None
+        kept = np.arange(len(hashes))
+        if max_postings is not None:
+            kept = np.nonzero(lengths <= max_postings)[0]
+            profiling.count('stopped_hashes', len(hashes) - len(kept))
+        positions, track_ids, db_offsets = index.lookup(hashes[kept])
+        positions = kept[positions]
+        diffs = db_offsets.astype(np.int64) - np.asarray(offsets)[positions].astype(np.int64)
+        if weighted:
+            weights = np.log1p(len(index) / np.maximum(lengths[positions], 1))
+        else:
+            weights = np.ones(len(positions))
+    profiling.count('postings', len(track_ids))
+    return positions, track_ids, diffs, weights
+
+
+def match_postings(hashes, offsets, index, max_postings=MAX_POSTINGS, weighted=WEIGHT_BY_RARITY):
+    '''Same as lookup_postings without positions: returns (track_ids, diffs, weights)'''
+    return lookup_postings(hashes, offsets, index, max_postings, weighted)[1:]
+
+
+def get_offset_diffs(sample, index, max_postings=MAX_POSTINGS, weighted=WEIGHT_BY_RARITY):
+    '''sample and index are hashindex.Index instances.
+    Returns (track_ids, diffs, weights) arrays, one entry per posting shared by sample and index'''
+    return match_postings(sample.flat_hashes(), sample.offsets, index, max_postings, weighted)
+
+
+def offset_histogram(offset_diffs, binwidth=BINWIDTH):
+    '''Counts offset differences per (track, bin) pair.
+    Returns (pairs, counts, sums, scores) where pairs are sorted track << 32 | bin keys,
+    sums add up the differences in each pair to average them later and scores add up their weights.
+    Bins don't depend on the other differences, so histograms of disjoint hashes can be merged'''
+    track_ids, diffs, weights = offset_diffs
+    bins = diffs // binwidth + BIN_BIAS
+    pairs, inverse, counts = np.unique((np.asarray(track_ids, dtype=np.int64) << 32) | bins,
+                                       return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    sums = np.bincount(inverse, weights=diffs, minlength=len(pairs))
+    scores = np.bincount(inverse, weights=weights, minlength=len(pairs))
+    return pairs, counts, sums, scores
+
+
+def merge_histograms(histograms):
+    '''Adds up (pairs, counts, sums, scores) histograms'''
+    histograms = list(histograms)
+    if len(histograms) == 1:
+        return histograms[0]
+    pairs, inverse = np.unique(np.concatenate([h[0] for h in histograms] + [np.empty(0, dtype=np.int64)]),
+                               return_inverse=True)
+    inverse = inverse.ravel()
+    counts, sums, scores = (np.bincount(inverse, weights=np.concatenate([h[column] for h in histograms] + [np.empty(0)]),
+                                        minlength=len(pairs)) for column in (1, 2, 3))
+    return pairs, counts.astype(np.int64), sums, scores
+
+
+def rank_histogram(histogram, tracks, k=TOP_K):
+    '''Returns up to k Match tuples sorted by the score of their best bin'''
+    pairs, counts, sums, scores = histogram
+    if len(pairs) == 0:
+        return []
+    pair_tracks = pairs >> 32
+
+    # after ordering by (track, score), the best bin of a track is its last one
+    order = np.lexsort((scores, pair_tracks))
+    is_last = np.append(pair_tracks[order][1:] != pair_tracks[order][:-1], True)
+    best = order[is_last]
+    best = best[np.argsort(-scores[best], kind='stable')[:k]]
+    return [Match(tracks[pair_tracks[i]], int(counts[i]), float(sums[i] / counts[i] * HOP_LENGTH / SAMPLE_RATE),
+                  float(scores[i]))
+            for i in best]
+
+
+def best_bin_scores(histogram):
+    '''Returns the score of the best bin of every track in a histogram, in track order'''
+    pairs, _, _, scores = histogram
+    pair_tracks = pairs >> 32
+    starts = np.nonzero(np.append(True, pair_tracks[1:] != pair_tracks[:-1]))[0]
+    return np.maximum.reduceat(scores, starts) if len(scores) else scores
+
+
+def get_best_matches(offset_diffs, tracks, binwidth=BINWIDTH, k=TOP_K, candidates=CANDIDATES):
+    '''Scores offset differences in two stages. Raw hit scores per track are summed first, and
+    only the `candidates` best tracks get offset histograms. They are scored in batches, from
+    the best raw score down, until no track left can reach the top k: a track's best bin never
+    scores more than all its hits.
+    Returns up to k Match tuples sorted by the score of their best bin'''
+    track_ids, diffs, weights = offset_diffs
+    with profiling.stage('scoring'):
+        if len(track_ids) == 0:
+            return []
+        # linear in postings and tracks, no sorting of the postings
+        track_ids = np.asarray(track_ids, dtype=np.intp)
+        raw_scores = np.bincount(track_ids, weights=weights, minlength=len(tracks))
+        hits = np.count_nonzero(raw_scores)
+        profiling.count('candidate_tracks', hits)
+        n = min(candidates, hits)
+        ranked = np.argpartition(-raw_scores, n - 1)[:n] if n < len(raw_scores) else np.arange(n)
+        ranked = ranked[np.argsort(-raw_scores[ranked], kind='stable')]
+
+        # postings of the ranked tracks, grouped by rank
+        rank = np.full(len(raw_scores), n)
+        rank[ranked] = np.arange(n)
+        posting_ranks = rank[track_ids]
+        selected = np.nonzero(posting_ranks < n)[0]
+        order = selected[np.argsort(posting_ranks[selected], kind='stable')]
+        bounds = np.searchsorted(posting_ranks[order], np.arange(n + 1))
+
+        histograms, aligned = [], np.empty(0)
+        done, batch = 0, max(k, 1)
+        while done < len(ranked):
+            stop = min(done + batch, len(ranked))
+            postings = order[bounds[done]:bounds[stop]]
+            histograms.append(offset_histogram((track_ids[postings], diffs[postings], weights[postings]), binwidth))
+            aligned = np.append(aligned, best_bin_scores(histograms[-1]))
+            done, batch = stop, batch * 2
+            if len(aligned) >= k and done < len(ranked) and np.partition(aligned, -k)[-k] >= raw_scores[ranked[done]]:
+                break
+        profiling.count('aligned_tracks', done)
+        # the batches hold different tracks, so their histograms are simply concatenated
+        return rank_histogram(tuple(np.concatenate(column) for column in zip(*histograms)), tracks, k)
+
+
+def snapshot(index):
+    '''Returns index as it is now, for queries that resolve looked up track ids with .tracks
+    while a segmented index may be updated or compacted on another thread'''
+    return index.snapshot() if isinstance(index, SegmentedIndex) else index
+
+
+def identify(fingerprint, index, binwidth=BINWIDTH, k=TOP_K):
+    '''fingerprint -- a (path, hashes, offsets) tuple of a sample
+    Returns up to k Match tuples'''
+    with profiling.record('query', fingerprint[0]):
+        if hasattr(index, 'best_matches'):
+            # sharded indexes score the hashes where their postings live
+            return index.best_matches(fingerprint[1], fingerprint[2], binwidth, k)
+        index = snapshot(index)
+        sample = Index.from_tracks([fingerprint])
+        return get_best_matches(get_offset_diffs(sample, index), index.tracks, binwidth, k)
+
+
+def posting_stats(index, top=20, max_postings=MAX_POSTINGS):
+    '''Posting list length statistics of any kind of index and what the stop-list skips,
+    see hashindex.posting_stats'''
+    if hasattr(index, 'postings'):
+        keys, lengths = index.postings()
+    else:
+        if isinstance(index, SegmentedIndex):
+            index = segments.merge_segments(index.segments)
+        keys, lengths = index.keys, np.diff(index.indptr)
+    stats = hashindex.posting_stats(keys, lengths, len(index), top)
+    if max_postings is not None:
+        stopped = lengths > max_postings
+        stats['stop_list'] = {'max_postings': max_postings, 'hashes': int(np.count_nonzero(stopped)),
+                              'postings': int(lengths[stopped].sum())}
+    return stats
+
+
+def spectrogram_params(sample_rate=SAMPLE_RATE):
+    return {'sample_rate': sample_rate, 'n_mels': N_MELS, 'fmax': FMAX, 'hop_length': HOP_LENGTH}
+
+
+def constellation_params(sample_rate=SAMPLE_RATE):
+    return dict(spectrogram_params(sample_rate), neighborhood_size=NEIGHBORHOOD_SIZE, min_db=MIN_PEAK_DB,
+                max_peaks=MAX_PEAKS_PER_CELL, peak_window=PEAK_WINDOW, peak_band=PEAK_BAND)
+
+
+def load_constellation(path, cache=None, file_hash=None):
+    '''Returns the constellation of an audio file, or None if path is not audio.
+    cache -- optional featurecache.FeatureCache, consulted for the constellation and,
+    if it keeps spectrograms, for the mel spectrogram before decoding the file
+    file_hash -- content_hash of path, if the caller already has it'''
+    if cache is None:
+        S = load_spectrogram(path)
+        return find_peaks(S, MIN_PEAK_DB, MAX_PEAKS_PER_CELL) if S is not None else None
+
+    file_hash = file_hash or content_hash(path)
+    constellation_key = cache.key(file_hash, 'constellation', constellation_params())
+    if (constellation := cache.get(constellation_key)) is not None:
+        return constellation
+
+    S = None
+    if cache.spectrograms:
+        spectrogram_key = cache.key(file_hash, 'spectrogram', spectrogram_params())
+        S = cache.get(spectrogram_key)
+    if S is None:
+        if (S := load_spectrogram(path)) is None:
+            return None
+        if cache.spectrograms:
+            cache.put(spectrogram_key, S)
+    constellation = find_peaks(S, MIN_PEAK_DB, MAX_PEAKS_PER_CELL)
+    cache.put(constellation_key, constellation)
+    return constellation
+
+
+def fingerprint_file(path, cache=None, with_content_hash=False):
+    '''Decodes, fingerprints and drops the audio of a single file.
+    Returns a (path, hashes, offsets) tuple, or None if path is not audio.
+    with_content_hash adds the content_hash of path, computed only once with the cache'''
+    with profiling.record('fingerprint', path):
+        file_hash = content_hash(path) if with_content_hash else None
+        constellation = load_constellation(path, cache, file_hash)
+        if constellation is None:
+            return None
+        hashes, offsets = get_hashes(constellation)
+        return (path, hashes, offsets, file_hash) if with_content_hash else (path, hashes, offsets)
+
+
+def fingerprint_files(files, multiprocess=False, workers=WORKERS, chunksize=CHUNKSIZE, cache=None, progress=None,
+                      with_content_hash=False):
+    '''Lazily yields (path, hashes, offsets) tuples for audio files among files, see fingerprint_file.
+    With multiprocess == True every file is handled in a worker process and only
+    the compact hash arrays travel back, so memory does not grow with the number of files.
+    progress(done, total) is called after every file, total is None if files has no length;
+    an exception raised by it stops the work'''
+    fingerprint = partial(fingerprint_file, cache=cache, with_content_hash=with_content_hash)
+    total = len(files) if hasattr(files, '__len__') else None
+    with mp.Pool(workers) if multiprocess else nullcontext() as pool:
+        results = pool.imap_unordered(fingerprint, files, chunksize) if multiprocess else map(fingerprint, files)
+        for done, result in enumerate(results, 1):
+            if progress is not None:
+                progress(done, total)
+            if multiprocess and cache is not None and done % EVICT_EVERY == 0:
+                # workers get a fresh copy of the cache with every task, their write counts never add up
+                cache.evict()
+            if result is not None:
+                yield result
+    if cache is not None:
+        cache.evict()
+
+
+def create_index(path, recursive=False, multiprocess=False, workers=WORKERS, cache=None, progress=None):
+    '''path is an audio file, a directory or a tuple of audio files.
+    The whole index is built in memory, sync_index a SegmentedIndex to ingest a large library'''
+    if isinstance(path, tuple):
+        files = path
+    elif os.path.isfile(path):
+        files = [path]
     elif os.path.isdir(path):
-        ts_coll = load_and_resample_dir(path, recursive)
+        files = iter_files(path, recursive)
+    return Index.from_tracks(list(fingerprint_files(files, multiprocess, workers, cache=cache, progress=progress)))
+
 
-    if multiprocess:
-        pool = mp.Pool(CPUs)
-        constellations = [pool.apply(path_and_constellation, args=(path_ts,)) for path_ts in ts_coll]
-        index = build_constellation_index(constellations, multiprocess, pool)
-        pool.close()
+def sync_index(index, path, recursive=False, multiprocess=False, workers=WORKERS, cache=None, progress=None):
+    '''Brings a segments.SegmentedIndex up to date with a directory or a tuple of files.
+    Unchanged files are skipped, new and changed ones are written as new segments of SEGMENT_FILES
+    files and, for a directory, indexed files that disappeared from it are removed.
+    Returns (changed, removed) lists of paths'''
+    if isinstance(path, tuple):
+        files, prune_under = [os.path.abspath(file) for file in path], None
     else:
-        constellations = [(path, form_constellation(ts)) for path, ts in ts_coll]
-        index = build_constellation_index(constellations)
-    return index
+        files, prune_under = [os.path.abspath(file) for file in iter_files(path, recursive)], path
+    changed, removed = index.plan_sync(files, prune_under)
+    batch, file_hashes, pending_removed = [], {}, removed
+    # the manifest needs the content hash of every file, the workers compute it while fingerprinting
+    for path, hashes, offsets, file_hash in fingerprint_files(changed, multiprocess, workers, cache=cache,
+                                                              progress=progress, with_content_hash=True):
+        batch.append((path, hashes, offsets))
+        file_hashes[path] = file_hash
+        if len(batch) == SEGMENT_FILES:
+            index.add_segment(batch, pending_removed, file_hashes)
+            batch, file_hashes, pending_removed = [], {}, ()
+    index.add_segment(batch, pending_removed, file_hashes)
+    if index.needs_compaction():
+        index.compact_in_background()
+    return changed, removed
 
 
-def update_index(index, dir_path_or_files):
-    if isinstance((files := dir_path_or_files), tuple):
-        for file in files:
-            index.update(create_index(file))
+def update_index(index, dir_path_or_files, recursive=False, multiprocess=False, workers=WORKERS, cache=None, progress=None):
+    if isinstance(index, SegmentedIndex):
+        sync_index(index, dir_path_or_files, recursive, multiprocess, workers, cache, progress)
+    elif isinstance((files := dir_path_or_files), tuple):
+        index.update(create_index(files, multiprocess=multiprocess, workers=workers, cache=cache, progress=progress))
     elif os.path.isdir(dir_path := dir_path_or_files):
-        new_index = create_index(dir_path)
+        new_index = create_index(dir_path, recursive, multiprocess=multiprocess, workers=workers, cache=cache,
+                                 progress=progress)
         index.update(new_index)
 
 
+def index_exists(index_filename):
+    '''True if open_index_file finds an index at index_filename, without opening or loading it'''
+    import shards
+    return (shards.is_sharded_index(index_filename) or segments.is_segmented_index(index_filename)
+            or os.path.isfile(index_filename))
+
+
 def open_index_file(index_filename):
-    if os.path.exists(index_filename):    
-        with open(index_filename, 'rb') as file:
-                index = pickle.load(file)
-        return index
+    '''Opens a segmented index directory (or its manifest), a sharded index directory,
+    a binary index file, or loads a legacy pickled one'''
+    import shards
+    if shards.is_sharded_index(index_filename):
+        return shards.open_sharded_index(index_filename)
+    elif segments.is_segmented_index(index_filename):
+        return segments.open_segmented_index(index_filename)
+    elif os.path.isfile(index_filename):
+        if hashindex.is_index_file(index_filename):
+            return hashindex.load_index(index_filename)
+        return hashindex.load_pickle_index(index_filename)
     else:
         return None
 
 
 def save_index_file(index, index_filename):
-    with open(index_filename, 'wb') as file:
-        pickle.dump(index, file)
\ No newline at end of file
+    '''Segmented indexes are written as they are updated, there is nothing to save'''
+    if not isinstance(index, SegmentedIndex):
+        hashindex.save_index(index, index_filename)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit(f'Usage: python {sys.argv[0]} audio_file [audio_file ...]')
+    for path in sys.argv[1:]:
+        if (path_ts := load_and_resample(path)) is not None:
+            ts = path_ts[1]
+            constellation = form_constellation(ts)
+            hashes, _ = get_hashes(constellation)
+            print(f'{path}: {peaks_per_second(constellation, len(ts)):.1f} peaks/s, '
+                  f'{len(hashes) * SAMPLE_RATE / max(len(ts), 1):.1f} hashes/s')
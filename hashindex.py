@@ -0,0 +1,262 @@
+import os
+import pickle
+import struct
+import numpy as np
+
+HASH_DTYPE = np.uint32
+TRACK_DTYPE = np.uint32
+OFFSET_DTYPE = np.uint32
+
+# On-disk format: header, track table, hash directory (keys, indptr), postings (track ids, offsets).
+# Every section starts at an 8 byte aligned position so arrays can be memory-mapped in place.
+MAGIC = b'RAZAMIDX'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sIIQQQQQQQQQ')
+
+
+def pack_hashes(f1, f2, dt):
+    '''Packs (f1, f2, dt) triples into single uint32 keys.
+    f1 and f2 are mel bins (8 bits each), dt is stored as a 16 bit two's complement'''
+    f1 = np.asarray(f1, dtype=np.uint32)
+    f2 = np.asarray(f2, dtype=np.uint32)
+    dt = np.asarray(dt, dtype=np.int64) & 0xFFFF
+    return ((f1 << 24) | (f2 << 16) | dt.astype(np.uint32)).astype(HASH_DTYPE)
+
+
+def unpack_hashes(hashes):
+    '''Inverse of pack_hashes. Returns (f1, f2, dt) arrays'''
+    hashes = np.asarray(hashes, dtype=np.uint32)
+    f1 = (hashes >> 24) & 0xFF
+    f2 = (hashes >> 16) & 0xFF
+    dt = (hashes & 0xFFFF).astype(np.int16).astype(np.int64)
+    return f1, f2, dt
+
+
+def gather_ranges(starts, stops):
+    '''Returns flat positions covering every [start, stop) range, in order'''
+    lengths = stops - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+    shifts = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return shifts + np.arange(total)
+
+
+class Index:
+    '''Inverted index of packed hashes.
+    tracks -- list of track paths, position in the list is the track id
+    keys -- sorted unique packed hashes
+    indptr -- postings of keys[i] live in [indptr[i], indptr[i+1])
+    track_ids, offsets -- postings, sorted by (hash, track id, offset)'''
+
+    def __init__(self, tracks=None, keys=None, indptr=None, track_ids=None, offsets=None):
+        self.tracks = list(tracks) if tracks is not None else []
+        self.keys = keys if keys is not None else np.empty(0, dtype=HASH_DTYPE)
+        self.indptr = indptr if indptr is not None else np.zeros(1, dtype=np.int64)
+        self.track_ids = track_ids if track_ids is not None else np.empty(0, dtype=TRACK_DTYPE)
+        self.offsets = offsets if offsets is not None else np.empty(0, dtype=OFFSET_DTYPE)
+
+    @classmethod
+    def from_postings(cls, tracks, hashes, track_ids, offsets):
+        '''Builds an index from flat, unsorted posting arrays'''
+        hashes = np.asarray(hashes, dtype=HASH_DTYPE)
+        track_ids = np.asarray(track_ids, dtype=TRACK_DTYPE)
+        offsets = np.asarray(offsets, dtype=OFFSET_DTYPE)
+        order = np.lexsort((offsets, track_ids, hashes))
+        hashes, track_ids, offsets = hashes[order], track_ids[order], offsets[order]
+        keys, starts = np.unique(hashes, return_index=True)
+        indptr = np.append(starts, len(hashes)).astype(np.int64)
+        return cls(tracks, keys, indptr, track_ids, offsets)
+
+    @classmethod
+    def from_dict(cls, index_dict):
+        '''Converts a legacy {(f1, f2, dt): [(t1, path), ...]} index'''
+        ids = {}
+        f1s, f2s, dts, track_ids, offsets = [], [], [], [], []
+        for (f1, f2, dt), postings in index_dict.items():
+            for t1, path in postings:
+                f1s.append(f1)
+                f2s.append(f2)
+                dts.append(dt)
+                track_ids.append(ids.setdefault(path, len(ids)))
+                offsets.append(t1)
+        return cls.from_postings(list(ids), pack_hashes(f1s, f2s, dts), track_ids, offsets)
+
+    @classmethod
+    def from_tracks(cls, hashes_collection):
+        '''Builds an index from a list of (path, hashes, offsets) tuples'''
+        tracks = [path for path, _, _ in hashes_collection]
+        if not tracks:
+            return cls()
+        hashes = np.concatenate([h for _, h, _ in hashes_collection])
+        offsets = np.concatenate([o for _, _, o in hashes_collection])
+        track_ids = np.repeat(np.arange(len(tracks), dtype=TRACK_DTYPE),
+                              [len(h) for _, h, _ in hashes_collection])
+        return cls.from_postings(tracks, hashes, track_ids, offsets)
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __bool__(self):
+        return len(self.tracks) > 0
+
+    @property
+    def nbytes(self):
+        arrays = (self.keys, self.indptr, self.track_ids, self.offsets)
+        return sum(a.nbytes for a in arrays) + sum(len(t) for t in self.tracks)
+
+    def flat_hashes(self):
+        '''Returns the hash of every posting, aligned with track_ids and offsets'''
+        return np.repeat(self.keys, np.diff(self.indptr))
+
+    def find(self, hashes):
+        '''Returns (pos, found): positions in keys of hashes and the indices of hashes present'''
+        hashes = np.asarray(hashes, dtype=HASH_DTYPE)
+        pos = np.searchsorted(self.keys, hashes)
+        pos[pos == len(self.keys)] = 0
+        found = np.nonzero(self.keys[pos] == hashes)[0] if len(self.keys) else np.empty(0, dtype=np.int64)
+        return pos, found
+
+    def posting_lengths(self, hashes):
+        '''Returns the number of postings of every hash, 0 for hashes not in the index'''
+        pos, found = self.find(hashes)
+        lengths = np.zeros(len(pos), dtype=np.int64)
+        lengths[found] = self.indptr[pos[found] + 1] - self.indptr[pos[found]]
+        return lengths
+
+    def lookup(self, hashes):
+        '''Finds postings of the given hashes.
+        Returns (positions, track_ids, offsets) where positions index into hashes'''
+        pos, found = self.find(hashes)
+        starts = self.indptr[pos[found]]
+        stops = self.indptr[pos[found] + 1]
+        flat = gather_ranges(starts, stops)
+        positions = np.repeat(found, stops - starts)
+        return positions, self.track_ids[flat], self.offsets[flat]
+
+    def update(self, other):
+        '''Merges other index into this one.
+        Tracks present in both are replaced by their postings from other'''
+        if not other:
+            return
+        ids = {path: i for i, path in enumerate(self.tracks)}
+        replaced = np.array([ids[path] for path in other.tracks if path in ids], dtype=TRACK_DTYPE)
+        new_ids = []
+        for path in other.tracks:
+            if path not in ids:
+                ids[path] = len(self.tracks)
+                self.tracks.append(path)
+            new_ids.append(ids[path])
+        new_ids = np.array(new_ids, dtype=TRACK_DTYPE)
+
+        keep = ~np.isin(self.track_ids, replaced)
+        hashes = np.concatenate([self.flat_hashes()[keep], other.flat_hashes()])
+        track_ids = np.concatenate([self.track_ids[keep], new_ids[other.track_ids]])
+        offsets = np.concatenate([self.offsets[keep], other.offsets])
+        merged = Index.from_postings(self.tracks, hashes, track_ids, offsets)
+        self.keys, self.indptr = merged.keys, merged.indptr
+        self.track_ids, self.offsets = merged.track_ids, merged.offsets
+
+
+def posting_stats(keys, lengths, tracks, top=20):
+    '''Summarizes posting list lengths of sorted unique keys.
+    Returns a JSON-serializable dict with length percentiles and the `top` heaviest hashes'''
+    lengths = np.asarray(lengths, dtype=np.int64)
+    stats = {'tracks': tracks, 'hashes': len(keys), 'postings': int(lengths.sum())}
+    if len(lengths) == 0:
+        return stats
+    stats['lengths'] = {'mean': float(lengths.mean()), 'max': int(lengths.max()),
+                        **{f'p{q}': float(np.percentile(lengths, q)) for q in (50, 90, 99, 99.9)}}
+    heaviest = np.argsort(-lengths, kind='stable')[:top]
+    f1, f2, dt = unpack_hashes(np.asarray(keys)[heaviest])
+    stats['heaviest'] = [{'hash': int(keys[i]), 'f1': int(a), 'f2': int(b), 'dt': int(c), 'postings': int(lengths[i]),
+                          'share': float(lengths[i] / stats['postings'])}
+                         for i, a, b, c in zip(heaviest, f1, f2, dt)]
+    return stats
+
+
+def _aligned(position):
+    return (position + 7) // 8 * 8
+
+
+def save_index(index, filename):
+    '''Writes index in the binary format.
+    The file is replaced atomically, so processes that mapped the old file keep a consistent view'''
+    track_table = '\0'.join(index.tracks).encode('utf-8')
+    sections = [track_table,
+                index.keys.astype(HASH_DTYPE, copy=False),
+                index.indptr.astype(np.int64, copy=False),
+                index.track_ids.astype(TRACK_DTYPE, copy=False),
+                index.offsets.astype(OFFSET_DTYPE, copy=False)]
+    positions = []
+    position = HEADER.size
+    for section in sections:
+        position = _aligned(position)
+        positions.append(position)
+        position += len(section) if isinstance(section, bytes) else section.nbytes
+
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(index.tracks), len(index.keys),
+                         len(index.track_ids), len(track_table), *positions[1:], positions[0])
+    tmp_filename = f'{filename}.tmp'
+    with open(tmp_filename, 'wb') as file:
+        file.write(header)
+        for position, section in zip(positions, sections):
+            file.write(b'\0' * (position - file.tell()))
+            file.write(section if isinstance(section, bytes) else section.tobytes())
+    os.replace(tmp_filename, filename)
+
+
+def is_index_file(filename):
+    with open(filename, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def load_index(filename):
+    '''Opens a binary index file. Arrays are memory-mapped read-only,
+    so pages are only read when a lookup touches them and are shared between processes'''
+    with open(filename, 'rb') as file:
+        fields = HEADER.unpack(file.read(HEADER.size))
+        magic, version, _, n_tracks, n_keys, n_postings, table_size, *positions, table_pos = fields
+        if magic != MAGIC:
+            raise ValueError(f'{filename} is not a razam index file')
+        if version != FORMAT_VERSION:
+            raise ValueError(f'Unsupported index format version {version} in {filename}')
+        file.seek(table_pos)
+        track_table = file.read(table_size).decode('utf-8')
+
+    tracks = track_table.split('\0') if n_tracks else []
+    keys_pos, indptr_pos, track_ids_pos, offsets_pos = positions
+
+    def mapped(dtype, offset, count):
+        if count == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+    return Index(tracks,
+                 mapped(HASH_DTYPE, keys_pos, n_keys),
+                 mapped(np.int64, indptr_pos, n_keys + 1),
+                 mapped(TRACK_DTYPE, track_ids_pos, n_postings),
+                 mapped(OFFSET_DTYPE, offsets_pos, n_postings))
+
+
+def load_pickle_index(filename):
+    '''Loads a pickled index, either a legacy dict or an Index instance'''
+    with open(filename, 'rb') as file:
+        index = pickle.load(file)
+    if isinstance(index, dict):
+        index = Index.from_dict(index)
+    return index
+
+
+def convert_pickle_index(pickle_filename, index_filename):
+    index = load_pickle_index(pickle_filename)
+    save_index(index, index_filename)
+    return index
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) != 3:
+        sys.exit(f'Usage: python {sys.argv[0]} index.pkl index.rzi')
+    converted = convert_pickle_index(sys.argv[1], sys.argv[2])
+    print(f'Converted {len(converted)} tracks, {len(converted.track_ids)} postings to {sys.argv[2]}')
@@ -0,0 +1,110 @@
+import json
+import multiprocessing as mp
+import time
+from functools import partial
+import numpy as np
+import decode
+import functions as fu
+import profiling
+import shards
+
+# Samples handed to a worker at once
+CHUNKSIZE = 1
+
+# Index opened once in every worker process, memory-mapped files share the page cache
+worker_index = None
+
+
+def open_worker_index(index_path):
+    global worker_index
+    worker_index = fu.open_index_file(index_path)
+
+
+def identify_sample(path, index=None, binwidth=fu.BINWIDTH, k=fu.TOP_K):
+    '''Fingerprints and scores a single sample against index (the worker index by default).
+    Returns a JSON-serializable dict with matches and timings in seconds'''
+    return timed_identify(path, lambda: fu.fingerprint_file(path), index, binwidth, k)
+
+
+def identify_pcm(data, sample_rate, name='pcm', index=None, binwidth=fu.BINWIDTH, k=fu.TOP_K):
+    '''Same as identify_sample for raw 16 bit little-endian mono PCM bytes'''
+    def fingerprint():
+        import librosa
+        ts = np.frombuffer(data, dtype='<i2') / 32768.0
+        if sample_rate != fu.SAMPLE_RATE:
+            with profiling.stage('resample'):
+                ts = librosa.resample(ts, orig_sr=sample_rate, target_sr=fu.SAMPLE_RATE)
+        return (name, *fu.get_hashes(fu.form_constellation(ts)))
+    return timed_identify(name, fingerprint, index, binwidth, k)
+
+
+def timed_identify(name, fingerprint, index=None, binwidth=fu.BINWIDTH, k=fu.TOP_K):
+    index = index if index is not None else worker_index
+    with profiling.record('query', name):
+        start = time.perf_counter()
+        result = {'sample': name, 'matches': []}
+        try:
+            sample_fingerprint = fingerprint()
+            fingerprinted = time.perf_counter()
+            if sample_fingerprint is None:
+                result['error'] = 'not an audio file'
+            else:
+                result['matches'] = [match._asdict() for match in fu.identify(sample_fingerprint, index, binwidth, k)]
+        except Exception as e:
+            fingerprinted = time.perf_counter()
+            result['error'] = str(e)
+        end = time.perf_counter()
+        result['timings'] = {'fingerprint': fingerprinted - start, 'score': end - fingerprinted, 'total': end - start}
+    return result
+
+
+def fingerprint_sample(path):
+    '''Pool task: returns (path, fingerprint or the exception raised, seconds spent)'''
+    start = time.perf_counter()
+    try:
+        fingerprint = fu.fingerprint_file(path)
+    except Exception as e:
+        fingerprint = e
+    return path, fingerprint, time.perf_counter() - start
+
+
+def score_fingerprinted(path, fingerprint, seconds, index, binwidth=fu.BINWIDTH, k=fu.TOP_K):
+    '''Same as identify_sample for a sample fingerprint_sample fingerprinted in another process'''
+    def get_fingerprint():
+        if isinstance(fingerprint, Exception):
+            raise fingerprint
+        return fingerprint
+    result = timed_identify(path, get_fingerprint, index, binwidth, k)
+    result['timings']['fingerprint'] += seconds
+    result['timings']['total'] += seconds
+    return result
+
+
+def identify_files(index_path, samples, workers=fu.WORKERS, binwidth=fu.BINWIDTH, k=fu.TOP_K):
+    '''Lazily yields identify_sample results, in completion order.
+    Every worker process opens the index once; workers == 0 runs everything in this process.
+    Pool workers can't start shard processes of their own, so with local shards they only
+    fingerprint samples, which are scored in this process against one ShardedIndex'''
+    if workers == 0:
+        index = fu.open_index_file(index_path)
+        for path in samples:
+            yield identify_sample(path, index, binwidth, k)
+        return
+    if shards.has_local_shards(index_path):
+        # the pool starts first, so its workers don't inherit the connections to the shards
+        with mp.Pool(workers) as pool, fu.open_index_file(index_path) as index:
+            for path, fingerprint, seconds in pool.imap_unordered(fingerprint_sample, samples, CHUNKSIZE):
+                yield score_fingerprinted(path, fingerprint, seconds, index, binwidth, k)
+        return
+    identify = partial(identify_sample, binwidth=binwidth, k=k)
+    with mp.Pool(workers, initializer=open_worker_index, initargs=(index_path,)) as pool:
+        yield from pool.imap_unordered(identify, samples, CHUNKSIZE)
+
+
+def run(index_path, paths, output, recursive=False, workers=fu.WORKERS, binwidth=fu.BINWIDTH, k=fu.TOP_K):
+    '''Writes one JSON line per sample to output as soon as it is identified'''
+    if not fu.index_exists(index_path):
+        raise FileNotFoundError(f'No index found at {index_path}')
+    for result in identify_files(index_path, decode.iter_samples(paths, recursive), workers, binwidth, k):
+        output.write(json.dumps(result) + '\n')
+        output.flush()
@@ -1,22 +1,68 @@
-import os
+import time
 import pyaudio
 import numpy as np
-import wave
 from tkinter import TclError
 
 
 RECORD_SECONDS = 5
+# Longest a continuous recognition keeps listening without a confident match
+MAX_RECORD_SECONDS = 15
+# Waveform redraws per second
+MAX_FPS = 20
 CHUNK = 1024
 FORMAT = pyaudio.paInt16
 CHANNELS = 1
 RATE = 22050
 
-def record_draw_save(fig, ax, save_dir):
-    '''Records sound from microphone, draws waveform, and saves what\'s been recorded.
-    Returns True if everything worked'''
-    p = pyaudio.PyAudio()
+class WaveformPlot:
+    '''Waveform of the latest audio chunk, redrawn by blitting only the line.
+    set_data may be called from any thread, redraw only from the GUI thread'''
+
+    def __init__(self, fig, ax, max_fps=MAX_FPS):
+        ax.axis('off')
+        ax.set_ylim(-5000, 5000)
+        x = np.arange(0, CHUNK)
+        self.line, = ax.plot(x, np.zeros(CHUNK), '-', lw=2, c='k', animated=True)
+        self.fig = fig
+        self.ax = ax
+        self.interval = 1 / max_fps
+        self.last_redraw = 0
+        self.data = None
+        self.background = None
+        fig.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def on_draw(self, event):
+        self.background = self.fig.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.line)
+
+    def set_data(self, data):
+        self.data = data
+
+    def redraw(self):
+        '''Draws the latest chunk unless the previous redraw was less than 1 / max_fps seconds ago'''
+        now = time.monotonic()
+        if self.data is None or now - self.last_redraw < self.interval:
+            return
+        if self.background is None:
+            self.fig.canvas.draw()
+        self.last_redraw = now
+        data, self.data = self.data, None
+        self.line.set_ydata(data)
+        self.fig.canvas.restore_region(self.background)
+        self.ax.draw_artist(self.line)
+        self.fig.canvas.blit(self.ax.bbox)
 
-    stream = p.open(
+    def animate(self, widget):
+        '''Keeps redrawing on widget\'s event loop until the widget is destroyed'''
+        try:
+            self.redraw()
+            widget.after(int(self.interval * 1000), self.animate, widget)
+        except TclError:
+            pass
+
+
+def open_input_stream(p):
+    return p.open(
         format=FORMAT,
         channels=CHANNELS,
         rate=RATE,
@@ -24,35 +70,53 @@ def record_draw_save(fig, ax, save_dir):
         frames_per_buffer=CHUNK
     )
 
-    ax.axis('off')
-    ax.set_ylim(-5000, 5000)
-    x = np.arange(0, CHUNK)
-    line, = ax.plot(x, np.zeros(CHUNK), '-', lw=2, c='k')
+
+def record(on_chunk=None, stopped=None, seconds=RECORD_SECONDS):
+    '''Records sound from microphone without drawing, on_chunk(data) receives every int16 chunk.
+    Returns the recorded 16 bit PCM bytes, or None if stopped() returned True'''
+    p = pyaudio.PyAudio()
+
+    stream = open_input_stream(p)
     frames = []
 
-    for i in range(0, int(RATE / CHUNK * RECORD_SECONDS)):
-        try:
+    try:
+        for i in range(0, int(RATE / CHUNK * seconds)):
+            if stopped is not None and stopped():
+                return None
             data = stream.read(CHUNK)
             frames.append(data)
-            data_int = np.fromstring(data, dtype=np.int16)
-            line.set_ydata(data_int)
-            fig.canvas.draw()
-            fig.canvas.flush_events()
-        except TclError:
-            return None
-
-    stream.stop_stream()
-    stream.close()
-    p.terminate()
-
-    sample_filename = None
-    if frames:
-        sample_filename = os.path.join(save_dir, 'sample.wav')
-        wf = wave.open(sample_filename, 'wb')
-        wf.setnchannels(CHANNELS)
-        wf.setsampwidth(p.get_sample_size(FORMAT))
-        wf.setframerate(RATE)
-        wf.writeframes(b''.join(frames))
-        wf.close()
-    
-    return sample_filename
\ No newline at end of file
+            if on_chunk is not None:
+                on_chunk(np.frombuffer(data, dtype=np.int16))
+        return b''.join(frames)
+    finally:
+        stream.stop_stream()
+        stream.close()
+        p.terminate()
+
+
+def record_recognize(index, on_chunk=None, stopped=None, max_seconds=MAX_RECORD_SECONDS):
+    '''Records sound from microphone and identifies it while recording. Does no drawing,
+    so it can run off the GUI thread: on_chunk(data) receives every int16 chunk.
+    Stops as soon as the best match is confident, or after max_seconds.
+    Returns a list of Match tuples, or None if stopped() returned True'''
+    # streaming imports functions (librosa, numba), which thin clients recording for a server don't need
+    from streaming import StreamRecognizer
+    p = pyaudio.PyAudio()
+
+    stream = open_input_stream(p)
+    recognizer = StreamRecognizer(index)
+
+    try:
+        for i in range(0, int(RATE / CHUNK * max_seconds)):
+            if stopped is not None and stopped():
+                return None
+            data_int = np.frombuffer(stream.read(CHUNK), dtype=np.int16)
+            if on_chunk is not None:
+                on_chunk(data_int)
+            if recognizer.feed(data_int / 32768.0):
+                return recognizer.matches
+        return recognizer.finish()
+    finally:
+        stream.stop_stream()
+        stream.close()
+        p.terminate()
@@ -0,0 +1,175 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import nullcontext
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Setting it to a file path (or - for standard error) logs a JSON line per fingerprinted file
+# and per query from every process, including worker processes
+ENV_VARIABLE = 'RAZAM_PROFILE'
+
+callbacks = []
+_local = threading.local()
+_disabled = nullcontext()
+
+
+class Stats:
+    '''Timers, counters and gauges of one unit of work: a fingerprinted file or a query.
+    timings -- seconds spent per stage
+    counters -- e.g. peaks, hashes, postings scanned, candidate tracks
+    gauges -- the largest value seen, e.g. bytes of the spectrogram, peak RSS'''
+
+    def __init__(self, kind, name=None):
+        self.kind = kind
+        self.name = name
+        self.timings = {}
+        self.counters = {}
+        self.gauges = {}
+        self.seconds = 0.0
+
+    def add_time(self, stage, seconds):
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+    def count(self, counter, n):
+        self.counters[counter] = self.counters.get(counter, 0) + int(n)
+
+    def gauge(self, name, value):
+        self.gauges[name] = max(self.gauges.get(name, value), value)
+
+    def as_dict(self):
+        return {'kind': self.kind, 'name': self.name, 'seconds': self.seconds, 'pid': os.getpid(),
+                'timings': self.timings, 'counters': self.counters, 'gauges': self.gauges}
+
+
+class _Stage:
+    __slots__ = ('stats', 'stage', 'start')
+
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.stats.add_time(self.stage, time.perf_counter() - self.start)
+
+
+class _Record:
+    def __init__(self, kind, name):
+        self.stats = Stats(kind, name)
+
+    def __enter__(self):
+        _local.stats = self.stats
+        self.start = time.perf_counter()
+        return self.stats
+
+    def __exit__(self, *exc_info):
+        _local.stats = None
+        self.stats.seconds = time.perf_counter() - self.start
+        rss, _ = peak_rss()
+        if rss is not None:
+            self.stats.gauge('peak_rss', rss)
+        for callback in callbacks:
+            callback(self.stats)
+
+
+def peak_rss():
+    '''Returns the peak resident set size in bytes of this process and of its children, or Nones'''
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes, except on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit)
+
+
+###############################################################
+# Instrumented code calls these. Without callbacks nothing is recorded,
+# and they cost an attribute lookup
+def record(kind, name=None):
+    '''Context manager collecting the stats of one unit of work and passing them to the callbacks.
+    Nested records add to the outer one'''
+    if not callbacks or getattr(_local, 'stats', None) is not None:
+        return _disabled
+    return _Record(kind, name)
+
+
+def stage(name):
+    '''Context manager timing a stage of the current unit of work'''
+    stats = getattr(_local, 'stats', None)
+    return _disabled if stats is None else _Stage(stats, name)
+
+
+def count(counter, n=1):
+    if (stats := getattr(_local, 'stats', None)) is not None:
+        stats.count(counter, n)
+
+
+def gauge(name, value):
+    if (stats := getattr(_local, 'stats', None)) is not None:
+        stats.gauge(name, value)
+
+
+###############################################################
+def add_callback(callback):
+    '''callback(stats) is called with the Stats of every finished unit of work in this process'''
+    callbacks.append(callback)
+
+
+def remove_callback(callback):
+    callbacks.remove(callback)
+
+
+class JsonLinesExporter:
+    '''Callback writing one JSON line per unit of work to a stream'''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def __call__(self, stats):
+        line = json.dumps({'time': time.time(), **stats.as_dict()}) + '\n'
+        with self.lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+
+class Summary:
+    '''Callback adding up the stats of many units of work'''
+
+    def __init__(self):
+        self.units = {}
+
+    def __call__(self, stats):
+        total = self.units.setdefault(stats.kind, Stats(stats.kind))
+        total.count('units', 1)
+        total.seconds += stats.seconds
+        for stage, seconds in stats.timings.items():
+            total.add_time(stage, seconds)
+        for counter, n in stats.counters.items():
+            total.count(counter, n)
+        for name, value in stats.gauges.items():
+            total.gauge(name, value)
+
+    def as_dict(self):
+        return {kind: total.as_dict() for kind, total in self.units.items()}
+
+
+def export_to(path):
+    '''Logs JSON lines to path, - is standard error. Also sets the environment variable,
+    so worker processes started afterwards log to the same file'''
+    os.environ[ENV_VARIABLE] = path
+    # line buffered appends of whole lines don't interleave between processes
+    stream = sys.stderr if path == '-' else open(path, 'a', buffering=1, encoding='utf-8')
+    add_callback(JsonLinesExporter(stream))
+
+
+if os.environ.get(ENV_VARIABLE) and not callbacks:
+    export_to(os.environ[ENV_VARIABLE])
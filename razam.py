@@ -1,18 +1,40 @@
-import functions as fu
-import mic
+import argparse
 import os
-import time
+import shutil
+import sys
+import queue
+import threading
+from types import SimpleNamespace
+import multiprocessing as mp
 import tkinter as tk
 import tkinter.scrolledtext as tkst
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from tkinter.filedialog import askopenfilename, askopenfilenames, askdirectory
-from tempfile import TemporaryDirectory
+
+# functions (librosa, numba, scipy), mic (pyaudio) and matplotlib are imported on first use,
+# on a worker thread where possible, so the window shows up immediately
+
+# How often the Tk loop picks up messages from the worker thread
+POLL_MS = 100
+
+
+class Cancelled(Exception):
+    pass
+
 
 class MainApplication:
-    def __init__(self, master):
-        self.default_index_filename = 'index.pkl'
-        self.tmpdir = TemporaryDirectory()
+    def __init__(self, master, server_address=None):
+        self.default_index_filename = 'razam_index'
+        self.legacy_index_filenames = ('index.rzi', 'index.pkl')
+        self.feature_cache_dir = 'razam_cache'
+        self.index = None
+        self.worker = None
+        self.cancel_event = threading.Event()
+        self.messages = queue.Queue()
+        # With a server address the app is a thin client: samples are identified by the server
+        self.client = None
+        if server_address:
+            import server
+            self.client = server.Client(server_address)
 
         # Instantiate window
         self.master = master
@@ -64,7 +86,7 @@ class MainApplication:
         self.frame_status.pack_propagate(False)
         ###############################################################
         # Find frame
-        self.label_find = tk.Label(self.frame_find, text='To identify music, open a sample or record a 5 second sample',
+        self.label_find = tk.Label(self.frame_find, text='To identify music, open a sample or record one from the microphone',
                                     bd='3', fg='blue', font='Helvetica 9 bold')
 
         self.button_record = tk.Button(self.frame_find, text='Record Sample',
@@ -116,35 +138,135 @@ class MainApplication:
                                                 bg=self.frame_status.cget('bg'),
                                                 font='Courier 7')
         self.space_status.configure(state='disabled')
+        self.frame_progress = tk.Frame(self.frame_status)
+        self.label_progress = tk.Label(self.frame_progress, text='', anchor='w', font='Courier 7')
+        self.button_cancel = tk.Button(self.frame_progress, text='Cancel', command=self.cancel_clicked)
+        self.button_cancel['state'] = 'disabled'
 
         self.label_status.pack(anchor='w')
+        self.frame_progress.pack(fill=tk.X)
+        self.label_progress.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.button_cancel.pack(side=tk.RIGHT)
         self.space_status.pack(fill=tk.BOTH)
         
         ###############################################################
         self.master.update()
         self.master.minsize(self.master.winfo_width(), self.master.winfo_height())
         
-    def __del__(self):
-        self.tmpdir.cleanup()
+    ###############################################################
+    # Background work. Heavy tasks run on one worker thread; they talk to the
+    # widgets only through self.messages, which the Tk loop drains every POLL_MS
+    def run_in_background(self, description, task, on_done=None):
+        '''Runs task() on the worker thread, then on_done(result) on the Tk thread'''
+        if self.is_busy():
+            self.write_to_text_widget(self.space_status, 'Please wait until the current task finishes or cancel it.')
+            return
+        self.cancel_event.clear()
+        self.button_cancel['state'] = 'normal'
+
+        def work():
+            try:
+                result = task()
+                if on_done is not None:
+                    self.messages.put(('call', lambda: on_done(result)))
+            except Cancelled:
+                self.post_status(f'{description} cancelled.')
+            except Exception as e:
+                self.post_status(f'{description} failed: {e}')
+            finally:
+                self.messages.put(('finished', None))
+
+        self.worker = threading.Thread(target=work, daemon=True)
+        self.worker.start()
+
+    def is_busy(self):
+        return self.worker is not None and self.worker.is_alive()
+
+    def poll_messages(self):
+        try:
+            while True:
+                kind, content = self.messages.get_nowait()
+                if kind == 'status':
+                    self.write_to_text_widget(self.space_status, content)
+                elif kind == 'progress':
+                    self.label_progress['text'] = content
+                elif kind == 'call':
+                    try:
+                        content()
+                    except Exception as e:
+                        # the loop must keep polling, or every later message is lost
+                        self.write_to_text_widget(self.space_status, f'Showing the result failed: {e}')
+                elif kind == 'finished':
+                    self.label_progress['text'] = ''
+                    self.button_cancel['state'] = 'disabled'
+        except queue.Empty:
+            pass
+        self.master.after(POLL_MS, self.poll_messages)
+
+    def post_status(self, content):
+        '''Thread-safe write_to_text_widget for the status widget'''
+        self.messages.put(('status', content))
+
+    def report_progress(self, done, total):
+        '''Progress callback for indexing, raises Cancelled once cancel was clicked'''
+        if self.cancel_event.is_set():
+            raise Cancelled
+        self.messages.put(('progress', f'{done} of {total} files processed' if total else f'{done} files processed'))
+
+    def cancel_clicked(self):
+        self.cancel_event.set()
+        self.write_to_text_widget(self.space_status, 'Cancelling...')
+
+    def feature_cache(self):
+        import functions as fu
+        return fu.FeatureCache(self.feature_cache_dir)
 
     ###############################################################
     def create_index_from_dir(self, recursive):
-        try:
-            dir_path = tk.filedialog.askdirectory(initialdir=os.getcwd())
-            if dir_path:
-                self.write_to_text_widget(self.space_status, f'Indexing audio files in {dir_path}...')
+        dir_path = tk.filedialog.askdirectory(initialdir=os.getcwd())
+        if dir_path:
+            self.write_to_text_widget(self.space_status, f'Indexing audio files in {dir_path}...')
+
+            def create():
+                import functions as fu
+                # the new index is built next to the current one, which stays usable until it is replaced
+                new_filename = f'{self.default_index_filename}.new'
+                shutil.rmtree(new_filename, ignore_errors=True)
+                try:
+                    new_index = fu.SegmentedIndex(new_filename)
+                    fu.update_index(new_index, dir_path, recursive, multiprocess=True,
+                                    cache=self.feature_cache(), progress=self.report_progress)
+                    if not new_index:
+                        return None
+                    # releases the mappings of the new segment files before they are moved
+                    del new_index
+                    index = self.open_default_index()
+                    if index.compaction is not None:
+                        # a compaction still running would add a merged segment of the old tracks afterwards
+                        index.compaction.join()
+                    index.replace_from(new_filename)
+                finally:
+                    shutil.rmtree(new_filename, ignore_errors=True)
+                return index
 
-                self.index = fu.create_index(dir_path, recursive)
-                if self.index:
+            def done(index):
+                if index:
                     self.index_filename = self.default_index_filename
-                    self.write_to_text_widget(self.space_status, f'Saving index to file {self.index_filename}...')
-                    fu.save_index_file(self.index, self.index_filename)
+                    self.index = index
                     self.write_to_text_widget(self.space_status, f'Index has been built, saved, and loaded. You can start searching.')
                     self.enable_widgets()
                 else:
                     self.write_to_text_widget(self.space_status, f'Indexing audio files in {dir_path} failed. No files in provided directory?')
-        except Exception as e:
-            self.write_to_text_widget(self.space_status, f'Something went wrong: {e}')
+
+            self.run_in_background('Indexing', create, done)
+
+    def open_default_index(self):
+        '''Returns the loaded index if it is the default one, so a directory never has two instances'''
+        import functions as fu
+        if isinstance(self.index, fu.SegmentedIndex) and \
+                os.path.abspath(self.index.directory) == os.path.abspath(self.default_index_filename):
+            return self.index
+        return fu.SegmentedIndex(self.default_index_filename)
 
     def create_rec_clicked(self):
         self.create_index_from_dir(recursive=True)
@@ -153,97 +275,172 @@ class MainApplication:
         self.create_index_from_dir(recursive=False)
 
     def load_index_on_start(self):
-        self.index_filename = self.default_index_filename
-        self.write_to_text_widget(self.space_status, f'Reading index file "{self.index_filename}"...')
-        self.index = None
-        self.index = fu.open_index_file(self.index_filename)
-        if self.index:
+        if self.client is not None:
+            self.connect_to_server()
+            return
+        self.write_to_text_widget(self.space_status, f'Reading index file "{self.default_index_filename}"...')
+
+        def load():
+            import functions as fu
+            legacy_filenames = [filename for filename in self.legacy_index_filenames if os.path.exists(filename)]
+            if not os.path.exists(self.default_index_filename) and legacy_filenames:
+                self.post_status(f'Converting "{legacy_filenames[0]}" to "{self.default_index_filename}"...')
+                fu.SegmentedIndex(self.default_index_filename).add_index(fu.open_index_file(legacy_filenames[0]))
+            return fu.open_index_file(self.default_index_filename)
+
+        self.run_in_background('Reading index', load, lambda index: self.index_loaded(index, self.default_index_filename))
+
+    def connect_to_server(self):
+        self.write_to_text_widget(self.space_status, f'Connecting to recognition server {self.client.address}...')
+
+        def done(status):
+            self.write_to_text_widget(self.space_status, f'Server has {status["tracks"]} tracks indexed. You can start searching.')
+            self.button_open_sample['state'] = 'normal'
+            self.button_record['state'] = 'normal'
+
+        self.run_in_background('Connecting to server', self.client.status, done)
+
+    def index_loaded(self, index, index_filename):
+        if index:
+            self.index = index
+            self.index_filename = index_filename
             self.write_to_text_widget(self.space_status, 'Index has been loaded. You can start searching.')
             self.enable_widgets()
         else:
             self.write_to_text_widget(self.space_status, 'No index found. Please create or load it to use the app.')
 
     def open_index_clicked(self):
-        try:
-            self.index_filename = tk.filedialog.askopenfilename(initialdir=os.getcwd())
-            if self.index_filename:
-                self.write_to_text_widget(self.space_status, f'Reading index file "{self.index_filename}"...')
-                self.index = fu.open_index_file(self.index_filename)
-                if self.index:
-                    self.write_to_text_widget(self.space_status, 'Index has been loaded. You can start searching.')
-                    self.enable_widgets()
-            else:
-                pass
-        except Exception as e:
-            self.write_to_text_widget(self.space_status, f'Something went wrong: {e}')
+        index_filename = tk.filedialog.askopenfilename(initialdir=os.getcwd())
+        if index_filename:
+            self.write_to_text_widget(self.space_status, f'Reading index file "{index_filename}"...')
+
+            def load():
+                import functions as fu
+                return fu.open_index_file(index_filename)
+
+            self.run_in_background('Reading index', load, lambda index: self.index_loaded(index, index_filename))
+
+    def update_index(self, dir_path_or_files, description):
+        self.write_to_text_widget(self.space_status, f'Updating index with {description}...')
+        index, index_filename = self.index, self.index_filename
+
+        def update():
+            import functions as fu
+            fu.update_index(index, dir_path_or_files, multiprocess=True,
+                            cache=self.feature_cache(), progress=self.report_progress)
+            fu.save_index_file(index, index_filename)
+
+        self.run_in_background(f'Updating index with {description}', update,
+                               lambda _: self.write_to_text_widget(self.space_status, f'Index has been updated and saved.'))
 
     def update_index_from_dir_clicked(self):
-        try:
-            dir_path = tk.filedialog.askdirectory(initialdir=os.getcwd())
-            if dir_path:
-                self.write_to_text_widget(self.space_status, f'Updating index with audio files in {dir_path}...')
-                fu.update_index(self.index, dir_path)
-                fu.save_index_file(self.index, self.index_filename)
-                self.write_to_text_widget(self.space_status, f'Index has been updated and saved.')
-        except Exception as e:
-            self.write_to_text_widget(self.space_status, f'Updating index with audio files in {dir_path} failed: {e}')
+        dir_path = tk.filedialog.askdirectory(initialdir=os.getcwd())
+        if dir_path:
+            self.update_index(dir_path, f'audio files in {dir_path}')
 
     def update_index_from_files_clicked(self):
-        try:
-            files = tk.filedialog.askopenfilenames(initialdir=os.getcwd())
-            if files:
-                self.write_to_text_widget(self.space_status, f'Updating index with selected audio files...')
-                fu.update_index(self.index, files)
-                fu.save_index_file(self.index, self.index_filename)
-                self.write_to_text_widget(self.space_status, f'Index has been updated and saved.')
-        except Exception as e:
-            self.write_to_text_widget(self.space_status, f'Updating index with selected audio files failed: {e}')
+        files = tk.filedialog.askopenfilenames(initialdir=os.getcwd())
+        if files:
+            self.update_index(tuple(files), 'selected audio files')
 
     def open_sample_clicked(self):
-        if self.index:
-            try:
-                sample_filename = tk.filedialog.askopenfilename(initialdir=os.getcwd())
-                if sample_filename:
-                    self.find_best_matches(sample_filename)
-            except Exception as e:
-                self.write_to_text_widget(self.space_status, f'Something went wrong: {e}')
+        if self.index or self.client is not None:
+            sample_filename = tk.filedialog.askopenfilename(initialdir=os.getcwd())
+            if sample_filename:
+                self.find_best_matches(sample_filename)
         else:
             self.write_to_text_widget(self.space_status, 'Please create or load index.')
 
     def record_clicked(self):
-        popup = tk.Tk()
+        if self.is_busy():
+            self.write_to_text_widget(self.space_status, 'Please wait until the current task finishes or cancel it.')
+            return
+        import mic
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+
+        popup = tk.Toplevel(self.master)
         popup.wm_title('Recording sample')
         popup.geometry(f'+{int(self.screenw/2.5)}+{int(self.screenh/2.5)}')
-        button_cancel = tk.Button(popup, text='Cancel', command=popup.destroy)
-        
-        fig, ax = plt.subplots()
+        button_cancel = tk.Button(popup, text='Cancel', command=self.cancel_clicked)
+        popup.protocol('WM_DELETE_WINDOW', self.cancel_clicked)
 
+        fig = Figure()
+        ax = fig.add_subplot()
         figure_canvas = FigureCanvasTkAgg(fig, master=popup)
         figure_canvas.get_tk_widget().pack()
         button_cancel.pack()
+        plot = mic.WaveformPlot(fig, ax)
+        figure_canvas.draw()
+        plot.animate(popup)
 
-        self.write_to_text_widget(self.space_status, 'Recording sample...')
-        sample_filename = mic.record_draw_save(fig, ax, save_dir=self.tmpdir.name)
-        if sample_filename:
-            self.write_to_text_widget(self.space_status, 'Sample recorded.')
-            popup.destroy()
-            self.find_best_matches(sample_filename)
+        self.write_to_text_widget(self.space_status, 'Listening...')
+        index = self.index
+
+        def record():
+            if self.client is not None:
+                data = mic.record(on_chunk=plot.set_data, stopped=self.cancel_event.is_set)
+                if data is None:
+                    raise Cancelled
+                return self.matches_from_server(self.client.identify_pcm(data, mic.RATE, 'microphone'))
+            best_matches = mic.record_recognize(index, on_chunk=plot.set_data, stopped=self.cancel_event.is_set)
+            if best_matches is None:
+                raise Cancelled
+            return best_matches
+
+        def done(best_matches):
+            self.write_to_text_widget(self.space_status, 'Sample recognized.')
+            self.delete_text_from_widget(self.space_results)
+            self.delete_text_from_widget(self.space_other_results)
+            self.show_matches(best_matches)
+
+        self.run_in_background('Recording sample', record, done)
+        self.close_when_idle(popup)
+
+    def close_when_idle(self, popup):
+        '''Destroys popup once the worker thread is done'''
+        if self.is_busy():
+            self.master.after(POLL_MS, self.close_when_idle, popup)
         else:
-            self.write_to_text_widget(self.space_status, 'Sample recording cancelled.')
-    
+            popup.destroy()
+
     def find_best_matches(self, sample_filename):
         self.delete_text_from_widget(self.space_results)
         self.delete_text_from_widget(self.space_other_results)
         self.write_to_text_widget(self.space_status, 'Processing sample...')
-        sample = fu.create_index(sample_filename)
-        self.write_to_text_widget(self.space_status, 'Finding best matches...')
-        offset_diffs = fu.get_offset_diffs(sample, self.index)
-        best_matches = fu.get_best_matches(offset_diffs)
-        self.write_to_text_widget(self.space_results, f'#1. {best_matches[0]}', where='1.0')
-        for i, match in enumerate(best_matches[1:6]):
-            self.write_to_text_widget(self.space_other_results, f'#{i+2}. {match}')
+        index = self.index
+
+        def identify():
+            if self.client is not None:
+                return self.matches_from_server(self.client.identify_file(sample_filename))
+            import functions as fu
+            fingerprint = fu.fingerprint_file(sample_filename)
+            if fingerprint is None:
+                raise ValueError(f'could not load {sample_filename} as audio')
+            self.post_status('Finding best matches...')
+            return fu.identify(fingerprint, index)
+
+        self.run_in_background('Processing sample', identify, self.show_matches)
+
+    def matches_from_server(self, result):
+        '''Plain objects with Match attributes, the thin client doesn't import functions'''
+        if 'error' in result:
+            raise RuntimeError(result['error'])
+        return [SimpleNamespace(**match) for match in result['matches']]
+
+    def show_matches(self, best_matches):
+        if not best_matches:
+            self.write_to_text_widget(self.space_status, 'No matches found for the provided sample.')
+            return
+        self.write_to_text_widget(self.space_results, f'#1. {self.format_match(best_matches[0])}', where='1.0')
+        for i, match in enumerate(best_matches[1:]):
+            self.write_to_text_widget(self.space_other_results, f'#{i+2}. {self.format_match(match)}')
         self.write_to_text_widget(self.space_status, f'Best matches for the provided sample found, check results.')
     
+    def format_match(self, match):
+        minutes, seconds = divmod(int(max(match.offset, 0)), 60)
+        return f'{match.path} ({match.count} hashes aligned at {minutes}:{seconds:02d})'
+
     def write_to_text_widget(self, widget, content, where='end'):
         widget.configure(state='normal')
         widget.insert(where, f'{content}\n')
@@ -262,12 +459,144 @@ class MainApplication:
         self.menu.entryconfig(3, state='normal')
 
 
-def launchApp():
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='razam', description='Music identification. Starts the GUI without a command.')
+    parser.add_argument('--server', help='address of a recognition server (host:port or unix:/path) the GUI should use')
+    parser.add_argument('--profile', metavar='FILE', help='log per-stage timings, counters and memory of every '
+                                                          'fingerprinted file and query as JSON lines (- is stderr)')
+    commands = parser.add_subparsers(dest='command')
+
+    identify_parser = commands.add_parser('identify', help='identify samples and print JSON lines')
+    identify_parser.add_argument('samples', nargs='+', help='sample files or directories')
+    identify_parser.add_argument('--index', default='razam_index', help='index directory or file')
+    identify_parser.add_argument('--recursive', action='store_true', help='look for samples in subdirectories')
+    identify_parser.add_argument('--workers', type=int,
+                                 help='worker processes, 0 runs in this process (default: CPU count)')
+    identify_parser.add_argument('--top', type=int, help='matches reported per sample (default: 6)')
+    identify_parser.add_argument('--binwidth', type=int, help='offset bin width in frames (default: 150)')
+    identify_parser.add_argument('--server', dest='identify_server',
+                                 help='send samples to a recognition server instead of loading the index')
+
+    serve_parser = commands.add_parser('serve', help='keep the index loaded and answer identify requests')
+    serve_parser.add_argument('--index', default='razam_index', help='index directory or file')
+    serve_parser.add_argument('--address', default='127.0.0.1:8765', help='host:port or unix:/path/to/socket')
+    serve_parser.add_argument('--workers', type=int, help='worker processes (default: CPU count)')
+
+    shard_parser = commands.add_parser('shard', help='split an index into hash-range shards')
+    shard_parser.add_argument('output', help='directory of the sharded index')
+    shard_parser.add_argument('--index', default='razam_index', help='index directory or file')
+    shard_parser.add_argument('--shards', type=int, default=mp.cpu_count(), help='number of shards (default: CPU count)')
+    shard_parser.add_argument('--addresses', help='comma separated host:port or unix:/path of shard services; '
+                                                  'without them shards run as child processes of the coordinator')
+
+    shard_serve_parser = commands.add_parser('serve-shard', help='serve one shard of a sharded index')
+    shard_serve_parser.add_argument('index', help='sharded index directory')
+    shard_serve_parser.add_argument('shard', type=int, help='shard number')
+    shard_serve_parser.add_argument('--address', required=True, help='host:port or unix:/path/to/socket')
+
+    scan_parser = commands.add_parser('scan', help='find catalogue tracks playing in long recordings, '
+                                                   'one JSON line per segment')
+    scan_parser.add_argument('recordings', nargs='+', help='recording files')
+    scan_parser.add_argument('--index', default='razam_index', help='index directory or file')
+    scan_parser.add_argument('--window', type=float, default=10, help='seconds of audio scored at once (default: 10)')
+    scan_parser.add_argument('--hop', type=float, default=2, help='seconds between windows (default: 2)')
+    scan_parser.add_argument('--binwidth', type=int, help='offset bin width in frames (default: 150)')
+
+    stats_parser = commands.add_parser('stats', help='report posting list lengths and the heaviest hashes as JSON')
+    stats_parser.add_argument('--index', default='razam_index', help='index directory or file')
+    stats_parser.add_argument('--top', type=int, default=20, help='heaviest hashes reported (default: 20)')
+
+    benchmark_parser = commands.add_parser('benchmark', help='measure speed, memory and accuracy on a synthetic corpus '
+                                                             'and print the results as JSON')
+    benchmark_parser.add_argument('--corpus', help='directory to keep the generated tracks in between runs '
+                                                   '(default: a temporary one)')
+    benchmark_parser.add_argument('--tracks', type=int, default=50, help='number of tracks (default: 50)')
+    benchmark_parser.add_argument('--seconds', type=float, default=30, help='track length (default: 30)')
+    benchmark_parser.add_argument('--queries', type=int, default=100, help='number of query clips (default: 100)')
+    benchmark_parser.add_argument('--clip', type=float, default=5, help='query clip length (default: 5)')
+    benchmark_parser.add_argument('--snr', type=float, default=10, help='query signal to noise ratio in dB (default: 10)')
+    benchmark_parser.add_argument('--seed', type=int, default=0, help='corpus and query seed (default: 0)')
+    benchmark_parser.add_argument('--workers', type=int,
+                                  help='indexing worker processes, 0 indexes in this process (default: CPU count)')
+    benchmark_parser.add_argument('--binwidth', type=int, help='offset bin width in frames (default: 150)')
+    benchmark_parser.add_argument('--output', help='file to append the JSON line to (default: standard output)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.profile:
+        import profiling
+        profiling.export_to(args.profile)
+    if args.command == 'identify' and args.identify_server:
+        import server
+        server.run_identify(args.identify_server, args.samples, sys.stdout, args.recursive, args.workers,
+                            args.binwidth, args.top)
+    elif args.command == 'identify':
+        import functions as fu
+        import identify
+        identify.run(args.index, args.samples, sys.stdout, args.recursive, args.workers,
+                     args.binwidth or fu.BINWIDTH, args.top or fu.TOP_K)
+    elif args.command == 'serve':
+        import server
+        server.serve(args.index, args.address, args.workers)
+    elif args.command == 'shard':
+        import functions as fu
+        import shards
+        index = fu.open_index_file(args.index)
+        if index is None:
+            sys.exit(f'No index found at {args.index}')
+        shards.split_index(index, args.output, args.shards, args.addresses.split(',') if args.addresses else None)
+    elif args.command == 'serve-shard':
+        import shards
+        try:
+            shards.serve_shard_service(args.index, args.shard, args.address)
+        except ValueError as e:
+            sys.exit(str(e))
+    elif args.command == 'scan':
+        import json
+        import functions as fu
+        import scan
+        index = fu.open_index_file(args.index)
+        if index is None:
+            sys.exit(f'No index found at {args.index}')
+        for recording in args.recordings:
+            try:
+                for segment in scan.scan_file(recording, index, args.window, args.hop,
+                                              binwidth=args.binwidth or fu.BINWIDTH):
+                    print(json.dumps({'recording': recording, **segment._asdict()}), flush=True)
+            except ValueError as e:
+                print(e, file=sys.stderr)
+    elif args.command == 'stats':
+        import json
+        import functions as fu
+        index = fu.open_index_file(args.index)
+        if index is None:
+            sys.exit(f'No index found at {args.index}')
+        print(json.dumps(fu.posting_stats(index, args.top), indent=2))
+    elif args.command == 'benchmark':
+        import json
+        import benchmark
+        import functions as fu
+        results = benchmark.run(args.corpus, args.tracks, args.seconds, args.queries, args.clip, args.snr,
+                                args.seed, args.workers, args.binwidth or fu.BINWIDTH)
+        if args.output:
+            with open(args.output, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(results) + '\n')
+        else:
+            print(json.dumps(results, indent=2))
+    else:
+        launchApp(args.server)
+
+
+def launchApp(server_address=None):
     window = tk.Tk()
     window.title("Razam v0.1")
-    c = MainApplication(window)
-    window.after(500, c.load_index_on_start)
+    c = MainApplication(window, server_address)
+    c.poll_messages()
+    c.load_index_on_start()
     window.mainloop()
     
 if __name__=='__main__':
-    launchApp()
\ No newline at end of file
+    mp.freeze_support()
+    main()
\ No newline at end of file
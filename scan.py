@@ -0,0 +1,125 @@
+from collections import namedtuple
+import numpy as np
+import decode
+import functions as fu
+import profiling
+from streaming import StreamFingerprinter
+
+# Scored windows of WINDOW_SECONDS, every HOP_SECONDS
+WINDOW_SECONDS = 10
+HOP_SECONDS = 2
+# A window matches a track with at least MIN_COUNT aligned hashes and MARGIN times the runner-up's score
+MIN_COUNT = 10
+MARGIN = 2.0
+# Hashes at most this many frames away from a window's alignment place the segment in time
+ALIGN_FRAMES = 2
+FRAMES_PER_SECOND = fu.SAMPLE_RATE / fu.HOP_LENGTH
+
+# start, end -- seconds into the recording, offset -- seconds into the track at start,
+# confidence -- 1 - runner-up score / best score, of the most confident window of the segment
+Segment = namedtuple('Segment', ['start', 'end', 'track', 'offset', 'confidence'])
+
+
+class Scanner:
+    '''Finds where catalogue tracks play in a long recording streamed through it once.
+    Every hash is looked up once, as soon as the fingerprinter completes it, and its postings
+    stay in a buffer while they belong to a sliding window, so memory doesn't grow
+    with the recording. Windows in which one track clearly wins are merged into segments
+    as long as the track stays aligned with the recording'''
+
+    def __init__(self, index, window=WINDOW_SECONDS, hop=HOP_SECONDS, min_count=MIN_COUNT, margin=MARGIN,
+                 binwidth=fu.BINWIDTH):
+        self.index = fu.snapshot(index)
+        self.window = max(int(window * FRAMES_PER_SECOND), 1)
+        self.hop = max(int(hop * FRAMES_PER_SECOND), 1)
+        self.min_count = min_count
+        self.margin = margin
+        self.binwidth = binwidth
+        # scored against track ids instead of paths, so Match.path is the id into self.index.tracks
+        self.track_range = range(len(self.index.tracks))
+        self.fingerprinter = StreamFingerprinter()
+        self.window_end = self.window
+        self.postings = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                         np.empty(0))
+        # the segment being extended: [start, end, track, diff, confidence], times in frames
+        self.segment = None
+
+    def feed(self, samples):
+        '''Returns the segments that ended before these samples'''
+        hashes, offsets = self.fingerprinter.feed(samples)
+        # hashes anchored before `done` are complete once their latest possible target is final
+        return self.add(hashes, offsets, self.fingerprinter.peaks_done - fu.TARGET_DT_MAX)
+
+    def finish(self):
+        '''Processes the end of the recording and returns the remaining segments'''
+        hashes, offsets = self.fingerprinter.flush()
+        segments = self.add(hashes, offsets, self.fingerprinter.num_frames, last=True)
+        if self.segment is not None:
+            segments.append(self.close_segment())
+        return segments
+
+    def add(self, hashes, offsets, done, last=False):
+        positions, track_ids, diffs, weights = fu.lookup_postings(hashes, offsets, self.index)
+        new = (offsets[positions].astype(np.int64), track_ids.astype(np.int64), diffs, weights)
+        self.postings = tuple(np.concatenate(arrays) for arrays in zip(self.postings, new))
+
+        segments = []
+        while self.window_end <= done or (last and self.window_end - self.window < done):
+            start = self.window_end - self.window
+            segments.extend(self.score_window(start, self.window_end))
+            self.window_end += self.hop
+            keep = self.postings[0] >= self.window_end - self.window
+            self.postings = tuple(array[keep] for array in self.postings)
+        return segments
+
+    def score_window(self, start, end):
+        times, track_ids, diffs, weights = self.postings
+        inside = times < end
+        matches = fu.get_best_matches((track_ids[inside], diffs[inside], weights[inside]), self.track_range,
+                                      self.binwidth, k=2)
+        runner_up = matches[1].score if len(matches) > 1 else 0
+        if not matches or matches[0].count < self.min_count or matches[0].score < self.margin * runner_up:
+            # nothing aligned here, a segment not extended for a whole window is over
+            if self.segment is not None and self.segment[1] < start:
+                return [self.close_segment()]
+            return []
+
+        best = matches[0]
+        track = best.path
+        # the most common difference of the best bin is the alignment, hashes far from it matched by chance
+        in_bin = inside & (track_ids == track) & (np.abs(diffs - best.offset * FRAMES_PER_SECOND) <= self.binwidth)
+        values, counts = np.unique(diffs[in_bin], return_counts=True)
+        diff = int(values[np.argmax(counts)])
+        aligned = in_bin & (np.abs(diffs - diff) <= ALIGN_FRAMES)
+        aligned_start, aligned_end = int(times[aligned].min()), int(times[aligned].max())
+        confidence = 1 - runner_up / best.score
+
+        segments = []
+        if self.segment is not None:
+            same = self.segment[2] == track and abs(self.segment[3] - diff) <= self.binwidth
+            if same and aligned_start <= self.segment[1] + self.window:
+                self.segment[1] = max(self.segment[1], aligned_end)
+                self.segment[4] = max(self.segment[4], confidence)
+                return []
+            segments.append(self.close_segment())
+        self.segment = [aligned_start, aligned_end, track, diff, confidence]
+        return segments
+
+    def close_segment(self):
+        start, end, track, diff, confidence = self.segment
+        self.segment = None
+        return Segment(start / FRAMES_PER_SECOND, end / FRAMES_PER_SECOND, self.index.tracks[track],
+                       (start + diff) / FRAMES_PER_SECOND, confidence)
+
+
+def scan_file(path, index, window=WINDOW_SECONDS, hop=HOP_SECONDS, min_count=MIN_COUNT, margin=MARGIN,
+              binwidth=fu.BINWIDTH):
+    '''Decodes a recording block by block and lazily yields the Segments of catalogue tracks playing in it.
+    Raises ValueError if path can't be decoded'''
+    if decode.sniff(path) is None:
+        raise ValueError(f'{path} is not audio')
+    scanner = Scanner(index, window, hop, min_count, margin, binwidth)
+    with profiling.record('scan', path):
+        for block in decode.iter_blocks(path, fu.SAMPLE_RATE):
+            yield from scanner.feed(block)
+        yield from scanner.finish()
@@ -0,0 +1,305 @@
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+import hashindex
+from hashindex import Index, TRACK_DTYPE
+
+MANIFEST_FILENAME = 'manifest.json'
+MANIFEST_VERSION = 1
+# Compact once an index has more segments than this
+MAX_SEGMENTS = 8
+# A compaction merges the smallest segments holding at most this many postings in all,
+# so its memory doesn't grow with the index. None merges everything
+MAX_COMPACT_POSTINGS = 50_000_000
+
+
+def content_hash(path, block_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        while block := file.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_entry(path, segment, sha1=None):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1, 'segment': segment}
+
+
+class SegmentsView:
+    '''Immutable (segments, tracks) of a SegmentedIndex at one point in time.
+    segments -- (name, index, base, alive) tuples, base is the id of the segment's first track in tracks'''
+
+    def __init__(self, segments, tracks):
+        self.segments = segments
+        self.tracks = tracks
+        self.live_tracks = sum(int(np.count_nonzero(alive)) for _, _, _, alive in segments)
+
+    def __len__(self):
+        return self.live_tracks
+
+    def __bool__(self):
+        return self.live_tracks > 0
+
+    @property
+    def nbytes(self):
+        return sum(index.nbytes for _, index, _, _ in self.segments)
+
+    def lookup(self, hashes):
+        '''Same as Index.lookup, with track ids pointing into self.tracks'''
+        found = []
+        for _, index, base, alive in self.segments:
+            positions, track_ids, offsets = index.lookup(hashes)
+            keep = alive[track_ids]
+            found.append((positions[keep], track_ids[keep].astype(np.int64) + base, offsets[keep]))
+        if not found:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=hashindex.OFFSET_DTYPE)
+        return tuple(np.concatenate(arrays) for arrays in zip(*found))
+
+    def posting_lengths(self, hashes):
+        '''Same as Index.posting_lengths, summed over segments.
+        Postings of removed tracks count until the segments are compacted'''
+        lengths = np.zeros(len(hashes), dtype=np.int64)
+        for _, index, _, _ in self.segments:
+            lengths += index.posting_lengths(hashes)
+        return lengths
+
+
+class SegmentedIndex:
+    '''Index stored in a directory as append-only segment files plus a manifest.
+    The manifest maps every indexed file to its (size, mtime, sha1) and to the segment
+    holding its postings; copies of a track in any other segment are dead and are
+    skipped by lookups until compaction drops them'''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.RLock()
+        self.compaction = None
+        os.makedirs(directory, exist_ok=True)
+        manifest_path = os.path.join(directory, MANIFEST_FILENAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, encoding='utf-8') as file:
+                manifest = json.load(file)
+            if manifest['version'] != MANIFEST_VERSION:
+                raise ValueError(f'Unsupported manifest version {manifest["version"]} in {directory}')
+        else:
+            manifest = {'version': MANIFEST_VERSION, 'next_segment': 0, 'segments': [], 'files': {}}
+        self.manifest = manifest
+        self.reload()
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, segment)
+
+    def reload(self):
+        '''Opens segment files and rebuilds the global track table and liveness masks.
+        They are published in one assignment, so a lookup running meanwhile sees either
+        the old or the new segments, never a mix'''
+        with self.lock:
+            files = self.manifest['files']
+            segments, tracks = [], []
+            for segment in self.manifest['segments']:
+                index = hashindex.load_index(self.segment_path(segment))
+                alive = np.array([files.get(path, {}).get('segment') == segment for path in index.tracks], dtype=bool)
+                segments.append((segment, index, len(tracks), alive))
+                tracks.extend(index.tracks)
+            self.view = SegmentsView(segments, tracks)
+
+    @property
+    def segments(self):
+        return self.view.segments
+
+    @property
+    def tracks(self):
+        return self.view.tracks
+
+    def snapshot(self):
+        '''Returns the current segments, unaffected by later updates and compactions.
+        Query with it when track ids from lookups are resolved with .tracks afterwards'''
+        return self.view
+
+    def save_manifest(self):
+        manifest_path = os.path.join(self.directory, MANIFEST_FILENAME)
+        with open(f'{manifest_path}.tmp', 'w', encoding='utf-8') as file:
+            json.dump(self.manifest, file)
+        os.replace(f'{manifest_path}.tmp', manifest_path)
+
+    def __len__(self):
+        return len(self.manifest['files'])
+
+    def __bool__(self):
+        return len(self) > 0
+
+    @property
+    def nbytes(self):
+        return self.view.nbytes
+
+    def lookup(self, hashes):
+        '''Same as Index.lookup, with track ids pointing into self.tracks'''
+        return self.view.lookup(hashes)
+
+    def posting_lengths(self, hashes):
+        return self.view.posting_lengths(hashes)
+
+    def plan_sync(self, files, prune_under=None):
+        '''Compares files with the manifest.
+        Returns (changed, removed): files to (re)index and indexed paths that no longer exist.
+        Only manifest entries under the prune_under directory are considered for removal'''
+        indexed = self.manifest['files']
+        changed, seen = [], set()
+        for path in files:
+            seen.add(path)
+            entry = indexed.get(path)
+            stat = os.stat(path)
+            if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                continue
+            if entry and entry['sha1'] and entry['size'] == stat.st_size and entry['sha1'] == content_hash(path):
+                entry['mtime'] = stat.st_mtime
+                continue
+            changed.append(path)
+
+        removed = []
+        if prune_under is not None:
+            prefix = os.path.join(os.path.abspath(prune_under), '')
+            removed = [path for path in indexed
+                       if path not in seen and os.path.abspath(path).startswith(prefix) and not os.path.exists(path)]
+        return changed, removed
+
+    def add_segment(self, hashes_collection, removed=(), file_hashes=None):
+        '''Writes (path, hashes, offsets) tuples as a new segment and drops removed paths.
+        Tracks already in the index are superseded by their new postings.
+        file_hashes -- optional {path: content_hash}, saves reading the files again'''
+        file_hashes = file_hashes or {}
+        with self.lock:
+            files = self.manifest['files']
+            for path in removed:
+                files.pop(path, None)
+            if hashes_collection:
+                segment = f'segment-{self.manifest["next_segment"]:06d}.rzi'
+                self.manifest['next_segment'] += 1
+                new_index = Index.from_tracks(hashes_collection)
+                hashindex.save_index(new_index, self.segment_path(segment))
+                for path in new_index.tracks:
+                    if os.path.exists(path):
+                        files[path] = file_entry(path, segment, file_hashes.get(path) or content_hash(path))
+                    else:
+                        files[path] = {'size': None, 'mtime': None, 'sha1': None, 'segment': segment}
+                self.manifest['segments'].append(segment)
+            self.save_manifest()
+            self.reload()
+
+    def add_index(self, index):
+        '''Imports a hashindex.Index (e.g. a converted single-file index) as one segment'''
+        hashes = index.flat_hashes()
+        order = np.argsort(index.track_ids, kind='stable')
+        starts = np.searchsorted(index.track_ids[order], np.arange(len(index.tracks) + 1))
+        self.add_segment([(path, hashes[order[starts[i]:starts[i + 1]]], index.offsets[order[starts[i]:starts[i + 1]]])
+                          for i, path in enumerate(index.tracks)])
+
+    def remove(self, paths):
+        self.add_segment([], removed=paths)
+
+    def clear(self):
+        self.remove(list(self.manifest['files']))
+        self.compact(max_postings=None)
+
+    def needs_compaction(self):
+        return len(self.segments) > MAX_SEGMENTS and len(compaction_plan(self.segments, MAX_COMPACT_POSTINGS)) > 1
+
+    def compact(self, max_postings=MAX_COMPACT_POSTINGS):
+        '''Merges the smallest segments holding at most max_postings postings into one, dropping dead postings.
+        Segments written while compaction runs are kept as they are'''
+        with self.lock:
+            snapshot = compaction_plan(self.segments, max_postings)
+        if not snapshot:
+            return
+
+        old_segments = {name for name, _, _, _ in snapshot}
+        merged = merge_segments(snapshot)
+        del snapshot
+
+        with self.lock:
+            segment = f'segment-{self.manifest["next_segment"]:06d}.rzi'
+            self.manifest['next_segment'] += 1
+            hashindex.save_index(merged, self.segment_path(segment))
+            for entry in self.manifest['files'].values():
+                if entry['segment'] in old_segments:
+                    entry['segment'] = segment
+            self.manifest['segments'] = [segment] + [name for name in self.manifest['segments'] if name not in old_segments]
+            self.save_manifest()
+            self.reload()
+        self.remove_segment_files(old_segments)
+
+    def remove_segment_files(self, names):
+        for name in names:
+            try:
+                os.remove(self.segment_path(name))
+            except OSError:
+                # still mapped by another process on platforms that forbid it, leave it behind
+                pass
+
+    def replace_from(self, directory):
+        '''Replaces all tracks with those of the segmented index in directory, on the same filesystem,
+        moving its segment files here. The directory itself isn't renamed and segment files in use
+        aren't overwritten, so it works while this index is mapped, also on Windows.
+        Nothing else may have the index in directory open'''
+        with open(os.path.join(directory, MANIFEST_FILENAME), encoding='utf-8') as file:
+            other = json.load(file)
+        with self.lock:
+            old_segments = list(self.manifest['segments'])
+            names = {}
+            for segment in other['segments']:
+                names[segment] = f'segment-{self.manifest["next_segment"]:06d}.rzi'
+                self.manifest['next_segment'] += 1
+                os.replace(os.path.join(directory, segment), self.segment_path(names[segment]))
+            self.manifest['files'] = {path: dict(entry, segment=names[entry['segment']])
+                                      for path, entry in other['files'].items()}
+            self.manifest['segments'] = [names[segment] for segment in other['segments']]
+            self.save_manifest()
+            self.reload()
+        self.remove_segment_files(old_segments)
+
+    def compact_in_background(self):
+        self.compaction = threading.Thread(target=self.compact, daemon=True)
+        self.compaction.start()
+        return self.compaction
+
+
+def compaction_plan(segments, max_postings):
+    '''Returns the smallest of (name, index, base, alive) segments whose postings add up to at most max_postings,
+    or an empty list if fewer than two fit. With max_postings None, all of them'''
+    if max_postings is None:
+        return list(segments)
+    chosen, total = [], 0
+    for segment in sorted(segments, key=lambda segment: len(segment[1].track_ids)):
+        total += len(segment[1].track_ids)
+        if total > max_postings:
+            break
+        chosen.append(segment)
+    return chosen if len(chosen) > 1 else []
+
+
+def merge_segments(segments):
+    '''Merges the live postings of (name, index, base, alive) segments into one Index'''
+    tracks, hashes, track_ids, offsets = [], [], [], []
+    for _, index, _, alive in segments:
+        keep = alive[index.track_ids]
+        new_ids = np.cumsum(alive, dtype=np.int64) - 1 + len(tracks)
+        tracks.extend(path for path, is_alive in zip(index.tracks, alive) if is_alive)
+        hashes.append(index.flat_hashes()[keep])
+        track_ids.append(new_ids[index.track_ids[keep]].astype(TRACK_DTYPE))
+        offsets.append(index.offsets[keep])
+    return Index.from_postings(tracks, np.concatenate(hashes), np.concatenate(track_ids), np.concatenate(offsets))
+
+
+def is_segmented_index(path):
+    if os.path.basename(path) == MANIFEST_FILENAME:
+        path = os.path.dirname(path)
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, MANIFEST_FILENAME))
+
+
+def open_segmented_index(path):
+    if os.path.basename(path) == MANIFEST_FILENAME:
+        path = os.path.dirname(path)
+    return SegmentedIndex(path)
@@ -0,0 +1,243 @@
+import asyncio
+import http.client
+import json
+import os
+import signal
+import socket
+import tempfile
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+DEFAULT_ADDRESS = '127.0.0.1:8765'
+MAX_BODY_BYTES = 64 << 20
+TIMEOUT = 120
+# Concurrent requests sent by identify_files
+REMOTE_REQUESTS = 8
+
+
+def parse_address(address):
+    '''Returns ('unix', path) for unix:/path addresses, ('tcp', (host, port)) for host:port'''
+    if address.startswith('unix:'):
+        return 'unix', address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return 'tcp', (host or '127.0.0.1', int(port))
+
+
+###############################################################
+# Worker processes. Each one opens the index once; memory-mapped
+# index files are shared between workers through the page cache
+def open_worker_index(index_path):
+    import identify
+    identify.open_worker_index(index_path)
+
+
+def identify_upload(data, suffix, name, binwidth, k):
+    import identify
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as file:
+        file.write(data)
+    try:
+        result = identify.identify_sample(file.name, binwidth=binwidth, k=k)
+    finally:
+        os.remove(file.name)
+    result['sample'] = name
+    return result
+
+
+def identify_pcm(data, sample_rate, name, binwidth, k):
+    import identify
+    return identify.identify_pcm(data, sample_rate, name, binwidth=binwidth, k=k)
+
+
+def count_tracks():
+    import identify
+    return len(identify.worker_index) if identify.worker_index is not None else 0
+
+
+###############################################################
+class RecognitionServer:
+    '''Serves identify requests over HTTP on a local TCP or Unix socket.
+    I/O runs on asyncio, fingerprinting and scoring in a pool of worker processes.
+
+    POST /identify   body is an audio file, or raw 16 bit little-endian mono PCM with ?format=pcm&rate=N;
+                     optional ?name=, ?k=, ?binwidth=
+    POST /reload     reopens the index in a fresh pool; requests already running finish on the old one
+    GET  /status     index path, number of tracks and reload generation'''
+
+    def __init__(self, index_path, address=DEFAULT_ADDRESS, workers=None):
+        self.index_path = index_path
+        self.address = address
+        self.workers = workers
+        self.generation = 0
+        self.pool = None
+        self.tracks = 0
+
+    async def reload(self):
+        pool = ProcessPoolExecutor(self.workers, initializer=open_worker_index, initargs=(self.index_path,))
+        loop = asyncio.get_running_loop()
+        tracks = await loop.run_in_executor(pool, count_tracks)
+        old_pool, self.pool, self.tracks = self.pool, pool, tracks
+        self.generation += 1
+        if old_pool is not None:
+            # lets requests submitted to the old pool finish without blocking the event loop
+            threading.Thread(target=old_pool.shutdown, daemon=True).start()
+
+    async def handle_identify(self, query, body):
+        import functions as fu
+        name = query.get('name', 'upload')
+        binwidth = int(query.get('binwidth', fu.BINWIDTH))
+        k = int(query.get('k', fu.TOP_K))
+        loop = asyncio.get_running_loop()
+        if query.get('format') == 'pcm':
+            rate = int(query.get('rate', fu.SAMPLE_RATE))
+            return await loop.run_in_executor(self.pool, identify_pcm, body, rate, name, binwidth, k)
+        suffix = os.path.splitext(name)[1]
+        return await loop.run_in_executor(self.pool, identify_upload, body, suffix, name, binwidth, k)
+
+    async def dispatch(self, method, target, body):
+        url = urlsplit(target)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if method == 'POST' and url.path == '/identify':
+            return 200, await self.handle_identify(query, body)
+        if method == 'POST' and url.path == '/reload':
+            await self.reload()
+            return 200, self.status()
+        if method == 'GET' and url.path == '/status':
+            return 200, self.status()
+        return 404, {'error': f'no such endpoint: {method} {url.path}'}
+
+    def status(self):
+        return {'index': self.index_path, 'tracks': self.tracks, 'generation': self.generation}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                key, _, value = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+            if len(request_line) != 3:
+                code, result = 400, {'error': 'malformed request'}
+            elif int(headers.get('content-length', 0)) > MAX_BODY_BYTES:
+                code, result = 413, {'error': f'body larger than {MAX_BODY_BYTES} bytes'}
+            else:
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                try:
+                    code, result = await self.dispatch(request_line[0], request_line[1], body)
+                except Exception as e:
+                    code, result = 500, {'error': str(e)}
+            payload = json.dumps(result).encode('utf-8')
+            writer.write(f'HTTP/1.1 {code} {http.client.responses[code]}\r\n'
+                         f'Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode('latin-1') + payload)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        await self.reload()
+        kind, where = parse_address(self.address)
+        if kind == 'unix':
+            if os.path.exists(where):
+                os.remove(where)
+            server = await asyncio.start_unix_server(self.handle_connection, where)
+        else:
+            server = await asyncio.start_server(self.handle_connection, *where)
+        if hasattr(signal, 'SIGHUP'):
+            loop = asyncio.get_running_loop()
+            loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.reload()))
+        print(f'Serving {self.tracks} tracks from {self.index_path} on {self.address}', flush=True)
+        async with server:
+            await server.serve_forever()
+
+
+def serve(index_path, address=DEFAULT_ADDRESS, workers=None):
+    asyncio.run(RecognitionServer(index_path, address, workers).serve())
+
+
+###############################################################
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=TIMEOUT):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class Client:
+    '''Thin client of a RecognitionServer, needs neither the index nor librosa'''
+
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=TIMEOUT):
+        self.address = address
+        self.timeout = timeout
+
+    def request(self, method, path, body=b'', **query):
+        kind, where = parse_address(self.address)
+        if kind == 'unix':
+            connection = UnixHTTPConnection(where, self.timeout)
+        else:
+            connection = http.client.HTTPConnection(*where, timeout=self.timeout)
+        query = {key: value for key, value in query.items() if value is not None}
+        try:
+            connection.request(method, f'{path}?{urlencode(query)}' if query else path, body,
+                               {'Content-Type': 'application/octet-stream'})
+            response = connection.getresponse()
+            result = json.loads(response.read().decode('utf-8'))
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise RuntimeError(result.get('error', f'server answered {response.status}'))
+        return result
+
+    def identify_file(self, path, binwidth=None, k=None):
+        with open(path, 'rb') as file:
+            result = self.request('POST', '/identify', file.read(), name=os.path.basename(path), binwidth=binwidth, k=k)
+        result['sample'] = path
+        return result
+
+    def identify_pcm(self, data, sample_rate, name='pcm', binwidth=None, k=None):
+        return self.request('POST', '/identify', data, format='pcm', rate=sample_rate, name=name, binwidth=binwidth, k=k)
+
+    def reload(self):
+        return self.request('POST', '/reload')
+
+    def status(self):
+        return self.request('GET', '/status')
+
+
+###############################################################
+# Batch client: no functions or librosa import, the server does the work
+def identify_files(address, samples, workers=None, binwidth=None, k=None):
+    '''Same as identify.identify_files, sending samples to a recognition server from `workers` threads'''
+    client = Client(address)
+
+    def identify_remote(path):
+        try:
+            return client.identify_file(path, binwidth, k)
+        except Exception as e:
+            return {'sample': path, 'matches': [], 'error': str(e)}
+
+    workers = workers or REMOTE_REQUESTS
+    with ThreadPoolExecutor(workers) as executor:
+        # keeps at most 2 * workers samples queued, so samples are read lazily
+        pending = set()
+        for path in samples:
+            pending.add(executor.submit(identify_remote, path))
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from (future.result() for future in done)
+        yield from (future.result() for future in as_completed(pending))
+
+
+def run_identify(address, paths, output, recursive=False, workers=None, binwidth=None, k=None):
+    '''Same as identify.run with the samples identified by the server at address.
+    binwidth and k default to the server's'''
+    import decode
+    for result in identify_files(address, decode.iter_samples(paths, recursive), workers, binwidth, k):
+        output.write(json.dumps(result) + '\n')
+        output.flush()
@@ -0,0 +1,339 @@
+import json
+import multiprocessing as mp
+import os
+import secrets
+import threading
+from multiprocessing.connection import Client, Listener
+import numpy as np
+import functions as fu
+import hashindex
+import profiling
+import segments
+from hashindex import Index, HASH_DTYPE
+
+SHARDS_FILENAME = 'shards.json'
+SHARDS_VERSION = 1
+SHARD_FILENAME = 'shard-{:03d}.rzi'
+HASH_SPACE = 1 << 32
+# Seconds a shard process gets to exit once its index is closed
+CLOSE_TIMEOUT = 5
+# Shard services unpickle what they receive, so they only talk to clients that know the index's secret key.
+# split_index writes a random one readable by its owner only, the environment variable overrides it
+KEY_FILENAME = 'shards.key'
+KEY_VARIABLE = 'RAZAM_SHARD_KEY'
+
+
+def shard_bounds(index, n_shards):
+    '''Splits the hash space into n_shards ranges holding about as many postings each.
+    Returns n_shards + 1 boundaries, shard i owns hashes in [bounds[i], bounds[i + 1])'''
+    if len(index.keys) == 0:
+        return np.linspace(0, HASH_SPACE, n_shards + 1).astype(np.int64)
+    # hashes are far from uniform (low anchor frequencies are the most common), so cut by postings
+    targets = np.arange(1, n_shards) * (len(index.track_ids) / n_shards)
+    cuts = np.minimum(np.searchsorted(index.indptr[1:], targets, side='right'), len(index.keys) - 1)
+    bounds = np.concatenate(([0], index.keys[cuts].astype(np.int64), [HASH_SPACE]))
+    return np.maximum.accumulate(bounds)
+
+
+def slice_index(index, start, stop):
+    '''Returns the postings of index with hashes in [start, stop), sharing its track table'''
+    lo, hi = np.searchsorted(index.keys, [start, stop])
+    first, last = index.indptr[lo], index.indptr[hi]
+    return Index(index.tracks, index.keys[lo:hi], index.indptr[lo:hi + 1] - first,
+                 index.track_ids[first:last], index.offsets[first:last])
+
+
+def split_index(index, directory, n_shards, addresses=None):
+    '''Writes index as n_shards hash-range shard files and a shards.json manifest to directory.
+    addresses -- optional host:port or unix:/path of each shard's service,
+                 the coordinator then connects to them instead of starting shard processes'''
+    if isinstance(index, segments.SegmentedIndex):
+        index = segments.merge_segments(index.segments)
+    if addresses is not None and len(addresses) != n_shards:
+        raise ValueError(f'{len(addresses)} addresses given for {n_shards} shards')
+    bounds = shard_bounds(index, n_shards)
+    os.makedirs(directory, exist_ok=True)
+    files = []
+    for i in range(n_shards):
+        files.append(SHARD_FILENAME.format(i))
+        hashindex.save_index(slice_index(index, bounds[i], bounds[i + 1]), os.path.join(directory, files[-1]))
+    manifest = {'version': SHARDS_VERSION, 'bounds': bounds.tolist(), 'shards': files}
+    if addresses is not None:
+        manifest['addresses'] = list(addresses)
+    write_key(directory)
+    manifest_path = os.path.join(directory, SHARDS_FILENAME)
+    with open(f'{manifest_path}.tmp', 'w', encoding='utf-8') as file:
+        json.dump(manifest, file)
+    os.replace(f'{manifest_path}.tmp', manifest_path)
+
+
+def write_key(directory):
+    '''Writes a new random key for the shard services of the sharded index in directory'''
+    key_path = os.path.join(directory, KEY_FILENAME)
+    if os.path.exists(key_path):
+        os.remove(key_path)
+    # created with owner-only permissions, never readable by others even briefly
+    fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w', encoding='utf-8') as file:
+        file.write(secrets.token_hex(32))
+
+
+def read_key(path):
+    '''Returns the key of the shard services of the sharded index at path, or None if it has none'''
+    if os.environ.get(KEY_VARIABLE):
+        return os.environ[KEY_VARIABLE].encode('utf-8')
+    if os.path.basename(path) == SHARDS_FILENAME:
+        path = os.path.dirname(path)
+    try:
+        with open(os.path.join(path, KEY_FILENAME), encoding='utf-8') as file:
+            return file.read().strip().encode('utf-8') or None
+    except FileNotFoundError:
+        return None
+
+
+def read_manifest(path):
+    if os.path.basename(path) == SHARDS_FILENAME:
+        path = os.path.dirname(path)
+    with open(os.path.join(path, SHARDS_FILENAME), encoding='utf-8') as file:
+        return path, json.load(file)
+
+
+def is_sharded_index(path):
+    if os.path.basename(path) == SHARDS_FILENAME:
+        path = os.path.dirname(path)
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, SHARDS_FILENAME))
+
+
+def has_local_shards(path):
+    '''True if opening the sharded index at path starts shard processes rather than connecting to services'''
+    return is_sharded_index(path) and not read_manifest(path)[1].get('addresses')
+
+
+def open_shard(path, shard):
+    '''Returns (index, start, stop) of shard number `shard` of the sharded index at path'''
+    directory, manifest = read_manifest(path)
+    index = hashindex.load_index(os.path.join(directory, manifest['shards'][shard]))
+    return index, manifest['bounds'][shard], manifest['bounds'][shard + 1]
+
+
+###############################################################
+# Shard side: answers requests of one coordinator connection
+def serve_shard(connection, index, start, stop):
+    while True:
+        try:
+            request = connection.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            if request[0] == 'histogram':
+                _, hashes, offsets, binwidth, max_postings, weighted = request
+                # a shard holds every posting of its hashes, so it applies the stop-list and weights alone
+                offset_diffs = fu.match_postings(hashes, offsets, index, max_postings, weighted)
+                connection.send(fu.offset_histogram(offset_diffs, binwidth))
+            elif request[0] == 'lookup':
+                connection.send(index.lookup(request[1]))
+            elif request[0] == 'lengths':
+                connection.send(index.posting_lengths(request[1]))
+            elif request[0] == 'postings':
+                connection.send((np.asarray(index.keys), np.diff(index.indptr)))
+            elif request[0] == 'info':
+                connection.send({'start': start, 'stop': stop, 'tracks': list(index.tracks),
+                                 'postings': len(index.track_ids), 'nbytes': index.nbytes})
+            elif request[0] == 'close':
+                connection.close()
+                return
+        except Exception as e:
+            connection.send(e)
+
+
+def shard_process(connection, path, shard):
+    serve_shard(connection, *open_shard(path, shard))
+
+
+def serve_shard_service(path, shard, address, authkey=None):
+    '''Serves one shard of the sharded index at path to coordinators connecting to address.
+    authkey defaults to the index's key. Raises ValueError if there is none'''
+    import server
+    authkey = authkey or read_key(path)
+    if not authkey:
+        raise ValueError(f'{path} has no {KEY_FILENAME} and {KEY_VARIABLE} is not set, '
+                         f'refusing to serve a shard without authentication')
+    index, start, stop = open_shard(path, shard)
+    kind, where = server.parse_address(address)
+    if kind == 'unix' and os.path.exists(where):
+        os.remove(where)
+    with Listener(where, 'AF_UNIX' if kind == 'unix' else 'AF_INET', authkey=authkey) as listener:
+        print(f'Serving shard {shard} [{start:#010x}, {stop:#010x}) of {path} on {address}', flush=True)
+        while True:
+            try:
+                connection = listener.accept()
+            except (mp.AuthenticationError, OSError) as e:
+                print(f'Rejected a connection: {e}')
+                continue
+            threading.Thread(target=serve_shard, args=(connection, index, start, stop), daemon=True).start()
+
+
+###############################################################
+class ShardedIndex:
+    '''Coordinator of hash-range shards, each one holding its postings in its own process.
+    A query scatters the sample's hashes to the shards owning them and merges the
+    per-track offset histograms they return, so only histograms cross process boundaries.
+    Shards are started as child processes, or connected to as services when the manifest
+    (or addresses) lists where they run, authenticating with the index's key. Safe to query from several threads at once'''
+
+    def __init__(self, path, addresses=None, authkey=None):
+        self.path = path
+        self.processes = []
+        self.connections = []
+        directory, manifest = read_manifest(path)
+        addresses = addresses or manifest.get('addresses')
+        if addresses:
+            import server
+            authkey = authkey or read_key(directory)
+            if not authkey:
+                raise ValueError(f'{path} has no {KEY_FILENAME} and {KEY_VARIABLE} is not set, '
+                                 f'cannot authenticate to its shard services')
+            for address in addresses:
+                kind, where = server.parse_address(address)
+                self.connections.append(Client(where, 'AF_UNIX' if kind == 'unix' else 'AF_INET', authkey=authkey))
+        else:
+            for shard in range(len(manifest['shards'])):
+                connection, child_connection = mp.Pipe()
+                process = mp.Process(target=shard_process, args=(child_connection, directory, shard), daemon=True)
+                process.start()
+                child_connection.close()
+                self.processes.append(process)
+                self.connections.append(connection)
+        self.locks = [threading.Lock() for _ in self.connections]
+
+        infos = self.scatter([(shard, ('info',)) for shard in range(len(self.connections))])
+        # services may be listed in any order, queries find a shard by its start
+        order = np.argsort([info['start'] for info in infos], kind='stable')
+        self.connections = [self.connections[i] for i in order]
+        self.infos = [infos[i] for i in order]
+        self.starts = np.array([info['start'] for info in self.infos], dtype=np.int64)
+        self.tracks = self.infos[0]['tracks']
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __bool__(self):
+        return len(self.tracks) > 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def nbytes(self):
+        return sum(info['nbytes'] for info in self.infos)
+
+    def scatter(self, requests):
+        '''Sends (shard, request) pairs and returns the answers in the same order.
+        All requests are sent before any answer is read, so the shards work in parallel.
+        Locks are taken in shard order and released as soon as a shard has answered,
+        so concurrent queries pipeline through the shards without deadlocking.
+        A connection that fails between sending a request and reading its answer is out
+        of sync and is closed; later requests to its shard raise ConnectionError'''
+        requests = sorted(requests, key=lambda request: request[0])
+        held, answers = [], []
+        try:
+            for shard, request in requests:
+                self.locks[shard].acquire()
+                held.append(shard)
+                if self.connections[shard] is None:
+                    raise ConnectionError(f'Shard {shard} of {self.path} is unavailable after an earlier failure')
+                self.connections[shard].send(request)
+            for shard, _ in requests:
+                answers.append(self.connections[shard].recv())
+                held.remove(shard)
+                self.locks[shard].release()
+        except BaseException:
+            for shard in held:
+                self.break_connection(shard)
+            raise
+        finally:
+            for shard in held:
+                self.locks[shard].release()
+        for answer in answers:
+            if isinstance(answer, Exception):
+                raise answer
+        return answers
+
+    def break_connection(self, shard):
+        '''Closes the connection of shard, the caller holds its lock'''
+        if self.connections[shard] is not None:
+            try:
+                self.connections[shard].close()
+            except OSError:
+                pass
+            self.connections[shard] = None
+
+    def split(self, hashes):
+        '''Returns (shard, positions) pairs of the shards owning some of hashes'''
+        owners = np.searchsorted(self.starts, hashes, side='right') - 1
+        order = np.argsort(owners, kind='stable')
+        shards, starts = np.unique(owners[order], return_index=True)
+        return zip(shards.tolist(), np.split(order, starts[1:]))
+
+    def best_matches(self, hashes, offsets, binwidth=fu.BINWIDTH, k=fu.TOP_K,
+                     max_postings=fu.MAX_POSTINGS, weighted=fu.WEIGHT_BY_RARITY):
+        '''Scores a sample's hashes on the shards, returns up to k Match tuples'''
+        hashes = np.asarray(hashes, dtype=HASH_DTYPE)
+        offsets = np.asarray(offsets)
+        with profiling.stage('offset_diffs'):
+            histograms = self.scatter([(shard, ('histogram', hashes[positions], offsets[positions],
+                                                binwidth, max_postings, weighted))
+                                       for shard, positions in self.split(hashes)])
+        with profiling.stage('scoring'):
+            return fu.rank_histogram(fu.merge_histograms(histograms), self.tracks, k)
+
+    def lookup(self, hashes):
+        '''Same as Index.lookup, for callers that need the postings themselves'''
+        hashes = np.asarray(hashes, dtype=HASH_DTYPE)
+        parts = list(self.split(hashes))
+        answers = self.scatter([(shard, ('lookup', hashes[positions])) for shard, positions in parts])
+        if not answers:
+            return Index().lookup(hashes)
+        return (np.concatenate([positions[answer[0]] for (_, positions), answer in zip(parts, answers)]),
+                np.concatenate([answer[1] for answer in answers]),
+                np.concatenate([answer[2] for answer in answers]))
+
+    def posting_lengths(self, hashes):
+        hashes = np.asarray(hashes, dtype=HASH_DTYPE)
+        lengths = np.zeros(len(hashes), dtype=np.int64)
+        parts = list(self.split(hashes))
+        for (_, positions), answer in zip(parts, self.scatter([(shard, ('lengths', hashes[positions]))
+                                                                for shard, positions in parts])):
+            lengths[positions] = answer
+        return lengths
+
+    def postings(self):
+        '''Returns (keys, posting lengths) of all shards'''
+        answers = self.scatter([(shard, ('postings',)) for shard in range(len(self.connections))])
+        return np.concatenate([keys for keys, _ in answers]), np.concatenate([lengths for _, lengths in answers])
+
+    def close(self):
+        for shard in range(len(self.connections)):
+            with self.locks[shard]:
+                connection = self.connections[shard]
+                if connection is None:
+                    continue
+                try:
+                    connection.send(('close',))
+                except OSError:
+                    pass
+                connection.close()
+        for process in self.processes:
+            # a shard whose connection broke may never see it close: forked siblings share its pipe
+            process.join(CLOSE_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.connections, self.processes = [], []
+
+
+def open_sharded_index(path):
+    return ShardedIndex(path)
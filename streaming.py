@@ -0,0 +1,115 @@
+import numpy as np
+import functions as fu
+
+AMIN = 1e-10
+TOP_DB = 80.0
+# Stop once the best match has at least MIN_COUNT aligned hashes and MARGIN times the runner-up's
+MIN_COUNT = 10
+MARGIN = 2.0
+
+
+class StreamFingerprinter:
+    '''Turns audio into hashes incrementally, keeping only the context the next chunk needs.
+    Mel frames are computed as samples arrive, a peak is final once the maximum filter
+    window after it is complete, and a hash is emitted as soon as its target peak is final.
+    dB levels are relative to the loudest frame seen so far instead of the whole recording'''
+
+    def __init__(self, sample_rate=fu.SAMPLE_RATE):
+        self.framer = fu.MelFramer(sample_rate)
+        self.frames = np.empty((fu.N_MELS, 0), dtype=np.float32)
+        self.frames_start = 0
+        self.num_frames = 0
+        self.peaks_done = 0
+        self.peaks = np.empty((0, 2), dtype=np.int64)
+        self.ref = AMIN
+        # frames after / before a peak that decide whether it is an isolated maximum
+        self.lookahead = fu.NEIGHBORHOOD_SIZE - fu.NEIGHBORHOOD_SIZE // 2
+        self.context = fu.NEIGHBORHOOD_SIZE // 2 + 1
+
+    def feed(self, samples):
+        '''samples -- mono audio at the fingerprinter sample rate
+        Returns (hashes, offsets) arrays of hashes completed by these samples'''
+        self.add_frames(self.framer.feed(samples))
+        return self.process(self.num_frames - self.lookahead)
+
+    def add_frames(self, frames):
+        self.frames = np.hstack((self.frames, frames))
+        self.num_frames += frames.shape[1]
+
+    def flush(self):
+        '''Pads the end of the stream like librosa does and returns the remaining hashes'''
+        self.add_frames(self.framer.flush())
+        return self.process(self.num_frames)
+
+    def process(self, done):
+        '''Finds peaks of frames in [self.peaks_done, done) and hashes them'''
+        if done <= self.peaks_done:
+            return fu.pack_hashes([], [], []), np.empty(0, dtype=np.uint32)
+        self.ref = max(self.ref, self.frames.max(initial=AMIN))
+        S = 10.0 * np.log10(np.maximum(self.frames, AMIN) / self.ref)
+        S = np.maximum(S, -TOP_DB)
+
+        peaks = fu.find_peaks(S, fu.MIN_PEAK_DB, max_peaks=None)
+        peaks[:, 0] += self.frames_start
+        peaks = peaks[(peaks[:, 0] >= self.peaks_done) & (peaks[:, 0] < done)]
+        if fu.MAX_PEAKS_PER_CELL is not None:
+            keep = fu.limit_peak_density(peaks[:, 0], peaks[:, 1],
+                                         S[peaks[:, 1], peaks[:, 0] - self.frames_start], fu.MAX_PEAKS_PER_CELL)
+            peaks = peaks[np.sort(keep)]
+        self.peaks_done = done
+
+        # drop frames no longer needed as context of the next peaks
+        drop = max(done - self.context - self.frames_start, 0)
+        self.frames = self.frames[:, drop:]
+        self.frames_start += drop
+
+        # anchors kept from earlier chunks already have their earlier targets in the buffer,
+        # so pairs ending in a new peak are exactly the pairs completed by this chunk
+        constellation = np.concatenate((self.peaks, peaks))
+        anchors, targets = fu.pair_peaks(constellation)
+        new = targets >= len(self.peaks)
+        hashes = fu.hash_pairs(constellation, anchors[new], targets[new])
+        self.peaks = constellation[constellation[:, 0] >= done - fu.TARGET_DT_MAX]
+        return hashes
+
+
+class StreamRecognizer:
+    '''Scores streamed audio against an index, accumulating offset differences across chunks'''
+
+    def __init__(self, index, min_count=MIN_COUNT, margin=MARGIN, binwidth=fu.BINWIDTH, k=fu.TOP_K):
+        self.index = fu.snapshot(index)
+        self.min_count = min_count
+        self.margin = margin
+        self.binwidth = binwidth
+        self.k = k
+        self.fingerprinter = StreamFingerprinter()
+        self.track_ids = np.empty(0, dtype=np.int64)
+        self.diffs = np.empty(0, dtype=np.int64)
+        self.weights = np.empty(0)
+        self.matches = []
+
+    def add_hashes(self, hashes, offsets):
+        if len(hashes) == 0:
+            return
+        track_ids, diffs, weights = fu.match_postings(hashes, offsets, self.index)
+        self.track_ids = np.concatenate((self.track_ids, track_ids))
+        self.diffs = np.concatenate((self.diffs, diffs))
+        self.weights = np.concatenate((self.weights, weights))
+        self.matches = fu.get_best_matches((self.track_ids, self.diffs, self.weights), self.index.tracks,
+                                           self.binwidth, self.k)
+
+    def feed(self, samples):
+        '''Returns True once the best match is confident'''
+        self.add_hashes(*self.fingerprinter.feed(samples))
+        return self.is_confident()
+
+    def is_confident(self):
+        if not self.matches:
+            return False
+        runner_up = self.matches[1].count if len(self.matches) > 1 else 0
+        return self.matches[0].count >= self.min_count and self.matches[0].count >= self.margin * runner_up
+
+    def finish(self):
+        '''Processes the end of the stream and returns the final matches'''
+        self.add_hashes(*self.fingerprinter.flush())
+        return self.matches